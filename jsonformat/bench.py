@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Benchmark harness for jsonf
+
+Generates reproducible synthetic JSON documents of the requested sizes and
+formats each of them with every mode (see MODES). For every combination it
+reports the throughput in MB/s and the peak RSS of the formatting process.
+
+Each run happens in a fresh subprocess, so the RSS numbers are not distorted
+by earlier runs. The subprocess also returns a checksum of its output: the
+streaming modes must produce exactly the same bytes as the ``json`` based
+modes they replace, otherwise the benchmark fails.
+
+The ``json`` modes load the whole document, which takes many times its size
+in memory. They are skipped for documents larger than --json-limit.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import tempfile
+import subprocess
+from optparse import OptionParser
+from os.path import join, getsize, abspath, dirname
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from jsonf.cli import format_json
+from jsonf.color import colorize
+from jsonf.stream import format_stream, read_chunks
+
+SEED = 42
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def make_record(rng, index):
+    """
+    One element of the generated documents, a mix of the types seen in
+    typical API responses.
+    """
+    return {
+        'id': index,
+        'name': 'item-%d' % rng.randint(0, 10 ** 6),
+        'score': rng.random() * 100,
+        'active': rng.random() < 0.5,
+        'parent': None,
+        'tags': [rng.choice(['red', 'green', 'blue', u'gr\xfcn'])
+                 for _ in range(rng.randint(0, 4))],
+        'meta': {'created': 1400000000 + index,
+                 'path': '/api/v1/items/%d' % index,
+                 'note': rng.choice(['', 'tab\there', 'quote "q"', 'plain'])},
+    }
+
+
+def make_document(filename, size):
+    """
+    Write a JSON array of records of about *size* bytes to *filename*.
+    """
+    rng = random.Random(SEED)
+    written = 0
+    index = 0
+    with open(filename, 'w') as fptr:
+        fptr.write('[')
+        while written < size:
+            text = json.dumps(make_record(rng, index))
+            if index:
+                text = ', ' + text
+            fptr.write(text)
+            written += len(text)
+            index += 1
+        fptr.write(']')
+
+
+def _json_unsorted(text):
+    from collections import OrderedDict
+    return json.dumps(json.loads(text, object_pairs_hook=OrderedDict),
+                      indent=4)
+
+
+#: name -> (function(filename, write), output identical to mode)
+MODES = {
+    'json-sorted': (
+        lambda filename, write: write(format_json(open(filename).read())),
+        None),
+    'json-unsorted': (
+        lambda filename, write: write(_json_unsorted(open(filename).read())),
+        None),
+    'stream-sorted': (
+        lambda filename, write: format_stream(
+            read_chunks(open(filename)), write, sort_keys=True),
+        'json-sorted'),
+    'stream-unsorted': (
+        lambda filename, write: format_stream(
+            read_chunks(open(filename)), write, sort_keys=False),
+        'json-unsorted'),
+    'stream-color': (
+        lambda filename, write: format_stream(
+            read_chunks(open(filename)),
+            lambda text: write(colorize(text)), sort_keys=False),
+        None),
+}
+
+
+def child(mode, filename):
+    """
+    Runs in the benchmark subprocess: format <filename> in <mode> and print
+    the elapsed time, peak RSS and output checksum as JSON.
+    """
+    import resource
+    digest = hashlib.sha1()
+
+    def write(text):
+        digest.update(text.encode('utf8'))
+
+    start = time.time()
+    MODES[mode][0](filename, write)
+    elapsed = time.time() - start
+    print(json.dumps({
+        'elapsed': elapsed,
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'sha1': digest.hexdigest(),
+    }))
+
+
+def run_mode(mode, filename):
+    output = subprocess.check_output([sys.executable, abspath(__file__),
+                                      '--run', mode, filename])
+    return json.loads(output.decode('ascii'))
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def bench(size, modes, json_limit, repeat, folder):
+    """
+    Generate a document of <size> bytes and time every mode on it. Returns
+    a dict: mode -> result dict (or None if skipped).
+    """
+    filename = join(folder, 'doc-%d.json' % size)
+    make_document(filename, size)
+    actual = getsize(filename)
+    results = {}
+    try:
+        for mode in modes:
+            if mode.startswith('json') and actual > json_limit:
+                results[mode] = None
+                continue
+            runs = [run_mode(mode, filename) for _ in range(repeat)]
+            best = min(runs, key=lambda x: x['elapsed'])
+            best['mb_s'] = actual / 1024.0 ** 2 / max(best['elapsed'], 1e-6)
+            results[mode] = best
+    finally:
+        os.unlink(filename)
+
+    for mode in modes:
+        reference = MODES[mode][1]
+        if results.get(mode) and results.get(reference):
+            if results[mode]['sha1'] != results[reference]['sha1']:
+                raise AssertionError('%s differs from %s on %d bytes' % (
+                    mode, reference, actual))
+    return actual, results
+
+
+def print_results(size, results):
+    print('%.0f MB document' % (size / 1024.0 ** 2))
+    for mode in sorted(results):
+        result = results[mode]
+        if result is None:
+            print('   %-16s skipped (see --json-limit)' % mode)
+            continue
+        print('   %-16s %8.2f MB/s %8.2fs %8d kB RSS' % (
+            mode, result['mb_s'], result['elapsed'], result['maxrss_kb']))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', default='1M,100M,1G',
+                      help='Comma separated document sizes. '
+                      'Default: %default')
+    parser.add_option('-m', '--modes', default=','.join(sorted(MODES)),
+                      help='Comma separated modes. Default: %default')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Runs per mode, the best is reported. '
+                      'Default: %default')
+    parser.add_option('--json-limit', default='200M',
+                      help='Largest document formatted with the json modes. '
+                      'Default: %default')
+    parser.add_option('-o', '--output', help='Save the results as JSON')
+    parser.add_option('--run', nargs=2, metavar='MODE FILE',
+                      help='Internal: run one mode in this process')
+    options, _ = parser.parse_args()
+
+    if options.run:
+        child(*options.run)
+        return
+
+    modes = options.modes.split(',')
+    json_limit = parse_size(options.json_limit)
+    folder = tempfile.mkdtemp(prefix='jsonf-bench-')
+    all_results = []
+    try:
+        for size in options.sizes.split(','):
+            actual, results = bench(parse_size(size), modes, json_limit,
+                                    options.repeat, folder)
+            print_results(actual, results)
+            all_results.append({'size': actual, 'results': results})
+    finally:
+        os.rmdir(folder)
+
+    if options.output:
+        with open(options.output, 'w') as fptr:
+            json.dump({'python': sys.version.split()[0],
+                       'results': all_results}, fptr, indent=1)
+
+
+if __name__ == '__main__':
+    main()
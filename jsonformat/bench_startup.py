@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Startup time check for jsonf
+
+Most runs of jsonf format small documents, where loading the modules takes
+longer than the formatting itself. This script imports ``jsonf.cli`` in fresh
+interpreters with ``python -X importtime`` (Python 3.7+) and reports the
+cumulative import time of the best run together with the slowest modules.
+
+It fails (exit status 1) if the import time exceeds --budget, or if any of
+the modules in HEAVY is loaded: those must only be imported when they are
+actually used (highlighting with ``--pygments``, ``--lines`` on a pool,
+``--serve``).
+
+With --requests N, it also formats a small document N times, once by
+running ``jsonf`` for each and once through a ``jsonf --serve`` server, and
+reports the latencies of both.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+from os.path import abspath, dirname, exists, join
+
+#: Modules which must not be loaded just by starting jsonf
+HEAVY = ('pygments', 'multiprocessing', 'asyncio')
+
+#: Document formatted by the latency comparison
+DOCUMENT = (b'{"id": 1234, "name": "example", "tags": ["a", "b", "c"], '
+            b'"size": 12.5, "owner": {"id": 5, "active": true}}')
+
+HERE = dirname(abspath(__file__))
+
+
+def import_times(module):
+    """
+    Import *module* in a new interpreter. Returns a list of
+    ``(name, self_us, cumulative_us)`` tuples, one per imported module.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=HERE, stderr=subprocess.PIPE)
+    _, output = process.communicate()
+    if process.returncode:
+        raise RuntimeError(output.decode('utf8', 'replace'))
+    times = []
+    for line in output.decode('utf8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue  # the header line
+        times.append((name.strip(), int(self_us), int(cumulative)))
+    return times
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    return 'p50 %7.2f ms   p90 %7.2f ms   max %7.2f ms' % (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.9)] * 1000, latencies[-1] * 1000)
+
+
+def process_latencies(count):
+    """
+    Format ``DOCUMENT`` *count* times with a new ``jsonf`` process each.
+    Returns the latencies in seconds.
+    """
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'jsonf.cli', '--color', 'never'],
+            cwd=HERE, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.communicate(DOCUMENT)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def server_latencies(count):
+    """
+    Format ``DOCUMENT`` *count* times on a ``jsonf --serve`` server, over
+    one connection. Returns the latencies in seconds.
+    """
+    sys.path.insert(0, HERE)
+    from jsonf.server import connect, send_request
+
+    directory = tempfile.mkdtemp()
+    path = join(directory, 'jsonf.sock')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'jsonf.cli', '--serve', path],
+        cwd=HERE, stderr=subprocess.DEVNULL)
+    try:
+        while not exists(path):
+            if server.poll() is not None:
+                raise RuntimeError('The server did not start')
+            time.sleep(0.01)
+        sock = connect(path)
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            send_request(sock, DOCUMENT)
+            latencies.append(time.perf_counter() - start)
+        sock.close()
+    finally:
+        server.terminate()
+        server.wait()
+        os.rmdir(directory)
+    return latencies
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-b', '--budget', type='float', default=50,
+                      help='Maximum import time of jsonf.cli in ms. '
+                      'Default: %default')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='Runs, the fastest is reported. Default: %default')
+    parser.add_option('-t', '--top', type='int', default=10,
+                      help='Number of slowest modules shown. '
+                      'Default: %default')
+    parser.add_option('-n', '--requests', type='int', default=0,
+                      help='Also compare the latency of N documents formatted '
+                      'by new processes and by a server. Default: %default')
+    options, _ = parser.parse_args()
+
+    runs = [import_times('jsonf.cli') for _ in range(options.repeat)]
+    best = min(runs, key=lambda times: times[-1][2])
+    total = best[-1][2] / 1000.0
+
+    print('Slowest modules (self time):')
+    for name, self_us, cumulative in sorted(
+            best, key=lambda x: x[1], reverse=True)[:options.top]:
+        print('   %-30s %8.2f ms %8.2f ms cumulative' % (
+            name, self_us / 1000.0, cumulative / 1000.0))
+    print('import jsonf.cli: %.2f ms (budget %.2f ms)' % (
+        total, options.budget))
+
+    status = 0
+    heavy = sorted(set(name.split('.')[0] for name, _, _ in best) &
+                   set(HEAVY))
+    if heavy:
+        print('FAIL: loaded at startup: %s' % ', '.join(heavy))
+        status = 1
+    if total > options.budget:
+        print('FAIL: over budget')
+        status = 1
+
+    if options.requests > 0:
+        print('Latency of %d documents:' % options.requests)
+        print('   process per document  %s' % _summary(
+            process_latencies(options.requests)))
+        print('   jsonf --serve         %s' % _summary(
+            server_latencies(options.requests)))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
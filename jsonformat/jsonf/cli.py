@@ -10,53 +10,184 @@ or, with headers::
 
    curl -i -H "Accept: application/json" -X GET http://url/ | jsonf
 
-Handling headers is *very* curl specific and not tested with any other source.
-Given that curl's output looks like a standard HTTP response, it should work
-with other tools too. YMMV.
+The headers of all responses are shown (``curl -i -L`` writes one block per
+redirect). Chunked and gzip or deflate compressed bodies, as written by
+``curl -i --raw``, are decoded while they are read (see jsonf.response).
+
+The document is formatted while it is read, so output starts right away and
+large documents do not need to fit in memory. Sorting keys (the default)
+means that each object is kept in memory until it is complete. Use
+``--unsorted`` to keep the original key order and constant memory use.
+
+Logs with one JSON document per line can be formatted with ``--lines``,
+using all CPUs.
+
+With ``--path``, only parts of the document are shown, for example::
+
+   curl http://url/ | jsonf --path '.items[*].metadata.name'
+
+Output to a terminal is syntax highlighted by a built-in colorizer (see
+``--color``). With ``--pygments``, the ``pygments`` package is used instead.
+
+Editors and scripts formatting many documents can start a server with
+``--serve`` instead of running ``jsonf`` for each one (see jsonf.server).
 """
 from __future__ import print_function
-from sys import stdin, stderr
+from optparse import OptionParser
+from sys import stdin, stdout, stderr, exit, version_info
 import json
 
-try:
+from jsonf.color import colorize
+from jsonf.lines import format_lines, iter_lines
+from jsonf.query import parse_path, select_stream
+from jsonf.response import read_response
+from jsonf.stream import format_stream
+
+
+def format_json(data):
+    return json.dumps(json.loads(data), sort_keys=True, indent=4)
+
+
+def highlighting_writer(write):
+    """
+    Wrap the callable *write* so that text is syntax highlighted before it
+    is written. Only complete lines are highlighted, the rest waits for the
+    next call, or for the returned ``flush`` function.
+
+    Raises ImportError if pygments is not available.
+    """
+    # imported here: loading pygments takes longer than formatting a small
+    # document, and most runs do not need it
     from pygments import highlight
     from pygments.lexers import JsonLexer
     from pygments.formatters import TerminalFormatter
-except ImportError:
-    pass
 
+    pending = []
+    lexer = JsonLexer()
+    formatter = TerminalFormatter()
+
+    def highlighted(text):
+        end = text.rfind('\n') + 1
+        if not end:
+            pending.append(text)
+            return
+        pending.append(text[:end])
+        write(highlight(''.join(pending), lexer, formatter))
+        pending[:] = [text[end:]]
+
+    def flush():
+        if ''.join(pending):
+            write(highlight(''.join(pending), lexer, formatter).rstrip('\n'))
+        del pending[:]
+
+    return highlighted, flush
 
-def format_json(data):
-    return json.dumps(json.loads(data), sort_keys=True, indent=4)
+
+def parse_args():
+    parser = OptionParser(usage='%prog [options] < document.json',
+                          description='Pretty-print the JSON document read '
+                          'from stdin.')
+    parser.add_option('-u', '--unsorted', dest='sort_keys',
+                      action='store_false', default=True,
+                      help='Keep keys in their original order. The document '
+                      'is then re-indented using constant memory.')
+    parser.add_option('-l', '--lines', action='store_true', default=False,
+                      help='Read one JSON document per line (JSON lines, '
+                      'NDJSON). Malformed lines are reported on stderr and '
+                      'skipped.')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='Number of processes formatting lines with '
+                      '--lines. Default: one per CPU.')
+    parser.add_option('-p', '--path',
+                      help='Only show the values at this path, for example '
+                      '.items[*].metadata.name (see jsonf.query).')
+    parser.add_option('--color', type='choice',
+                      choices=['auto', 'always', 'never'], default='auto',
+                      help='Syntax highlighting: auto (if stdout is a '
+                      'terminal), always or never. Default: %default')
+    parser.add_option('--pygments', action='store_true', default=False,
+                      help='Highlight with pygments instead of the built-in '
+                      'colorizer. Much slower on large documents.')
+    parser.add_option('--serve', metavar='SOCKET',
+                      help='Format the documents sent to the Unix socket '
+                      'SOCKET, or with "-" to stdin, until interrupted '
+                      '(see jsonf.server). Needs Python 3.7.')
+    parser.add_option('--queue-size', type='int', default=64,
+                      help='Requests waiting for the formatter with --serve. '
+                      'Default: %default')
+    options, args = parser.parse_args()
+    if options.serve is not None and (options.lines or options.pygments):
+        parser.error('--serve can not be used with --lines or --pygments')
+    if options.path is not None:
+        if options.lines:
+            parser.error('--path can not be used with --lines')
+        try:
+            options.path = parse_path(options.path)
+        except ValueError as exc:
+            parser.error(str(exc))
+    return options, args
 
 
 def main():
-    headers = []
-    content = []
-    active_list = headers
-    headers_done = False
-    for line in stdin:
-        if not headers_done and not line.strip():
-            active_list = content
-            continue
-        active_list.append(line)
-
-    if not content:
-        # no headers found, so the content had been loaded in the wrong list.
-        # Let's exchange them.
-        content, headers = headers, content
-
-    print(''.join(headers))
-    output = format_json(''.join(content))
+    options, _ = parse_args()
+    if options.serve is not None:
+        if version_info < (3, 7):
+            print('jsonf: --serve needs Python 3.7 or later', file=stderr)
+            return 2
+        # asyncio is slow to import (and not there on Python 2)
+        from jsonf.server import serve
+        return serve(options.serve, sort_keys=options.sort_keys,
+                     color=options.color == 'always', path=options.path,
+                     queue_size=options.queue_size)
+
+    # bytes: the body may be compressed
+    headers, chunks = read_response(getattr(stdin, 'buffer', stdin))
+    if headers:
+        print(''.join(headers))
+
+    color = options.color == 'always' or (
+        options.color == 'auto' and stdout.isatty())
+    write, flush = stdout.write, None
+    if color and options.pygments:
+        try:
+            write, flush = highlighting_writer(stdout.write)
+        except ImportError:
+            print('jsonf: --pygments needs the python package `pygments`',
+                  file=stderr)
+            return 2
+        color = False
+    elif color and not options.lines:
+        write = lambda text: stdout.write(colorize(text))
+
+    status = 0
     try:
-        print(highlight(output, JsonLexer(), TerminalFormatter()))
-    except NameError:
-        print(output)
-        print("NOTE: If you have the python package "
-              "`pygments` available for import, you'll get nice "
-              "syntax highlighting ^_^",
-              file=stderr)
+        if options.lines:
+            def error(line_number, message):
+                print('jsonf: line %d: %s' % (line_number, message),
+                      file=stderr)
+            # lines are colorized by the worker processes
+            if format_lines(iter_lines(chunks), write, error,
+                            sort_keys=options.sort_keys, jobs=options.jobs,
+                            color=color):
+                status = 1
+        elif options.path is not None:
+            # every value is followed by a line break
+            select_stream(chunks, options.path, write,
+                          sort_keys=options.sort_keys)
+        else:
+            format_stream(chunks, write, sort_keys=options.sort_keys)
+    except ValueError as exc:
+        # also raised for undecodable input (UnicodeDecodeError)
+        stdout.flush()
+        print('\njsonf: %s' % exc, file=stderr)
+        return 1
+
+    if flush is not None:
+        flush()
+    if not options.lines and options.path is None:
+        print()
+    return status
 
 
 if __name__ == '__main__':
-    main()
+    exit(main())
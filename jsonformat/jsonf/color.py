@@ -0,0 +1,46 @@
+"""
+ANSI syntax highlighting for formatted JSON.
+
+The text written by the formatter is highlighted piece by piece: each piece
+holds complete tokens and each key is followed by its ":". Tokens are found
+with a single regular expression and wrapped in precomputed escape sequences,
+which is much cheaper than running a general purpose lexer over the output.
+"""
+import re
+
+#: Escape sequences starting the color of each kind of token
+KEY = '\033[94m'
+STRING = '\033[33m'
+NUMBER = '\033[36m'
+LITERAL = '\033[35m'
+#: Escape sequence resetting the color
+RESET = '\033[39m'
+
+_TOKEN = re.compile(r'''
+    ("[^"\\]*(?:\\.[^"\\]*)*")(?=:)  # key
+  | ("[^"\\]*(?:\\.[^"\\]*)*")       # string
+  | (-?[0-9][0-9.eE+\-]*)            # number
+  | (true|false|null)                # literal
+''', re.VERBOSE)
+
+
+def colorizer(key=KEY, string=STRING, number=NUMBER, literal=LITERAL,
+              reset=RESET):
+    """
+    Returns a function adding the given escape sequences to a piece of
+    formatted JSON.
+    """
+    # indexed by the group of the matching token
+    starts = (None, key, string, number, literal)
+
+    def paint(match):
+        return starts[match.lastindex] + match.group() + reset
+
+    def colorize(text):
+        return _TOKEN.sub(paint, text)
+
+    return colorize
+
+
+#: Highlight a piece of formatted JSON with the default colors
+colorize = colorizer()
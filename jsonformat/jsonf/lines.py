@@ -0,0 +1,123 @@
+"""
+Formatting of JSON-lines (NDJSON) input: one JSON document per line.
+
+Each record is formatted on its own, so a malformed line only produces an
+error for that line. Records are sent to a pool of worker processes in
+batches and written back in their original order.
+"""
+from collections import deque
+
+from jsonf.color import colorize
+from jsonf.stream import format_stream
+
+#: Number of records sent to a worker at once
+BATCH_SIZE = 512
+
+
+def iter_lines(chunks):
+    """
+    Yield the lines (without line ending) of the text coming from the
+    iterable *chunks*.
+    """
+    pending = []
+    for chunk in chunks:
+        start = 0
+        end = chunk.find('\n')
+        while end >= 0:
+            pending.append(chunk[start:end])
+            yield ''.join(pending)
+            pending = []
+            start = end + 1
+            end = chunk.find('\n', start)
+        pending.append(chunk[start:])
+    if ''.join(pending):
+        yield ''.join(pending)
+
+
+def format_batch(batch, sort_keys=True, color=False):
+    """
+    Format a list of ``(line_number, line)`` tuples, syntax highlighted if
+    *color* is set.
+
+    Returns a list of ``(line_number, output, error)`` tuples, where either
+    *output* or *error* is ``None``. Blank lines are left out.
+    """
+    results = []
+    for line_number, line in batch:
+        if not line.strip():
+            continue
+        output = []
+        try:
+            format_stream([line], output.append, sort_keys)
+        except ValueError as exc:
+            results.append((line_number, None, str(exc)))
+        else:
+            output = ''.join(output)
+            if color:
+                output = colorize(output)
+            results.append((line_number, output, None))
+    return results
+
+
+def _batches(lines, size):
+    batch = []
+    for item in enumerate(lines, 1):
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def format_lines(lines, write, error, sort_keys=True, jobs=None,
+                 batch_size=BATCH_SIZE, color=False):
+    """
+    Format each JSON document in the iterable *lines* and write it, followed
+    by a newline, to the callable *write*. Malformed lines are reported as
+    ``error(line_number, message)``. With *color*, the output is syntax
+    highlighted.
+
+    With more than one job, batches of *batch_size* lines are formatted on
+    a pool of *jobs* processes (one per CPU by default). Only a few batches
+    per process are in flight at any time, so the input is read no faster
+    than it can be formatted.
+
+    Returns the number of malformed lines.
+    """
+    # multiprocessing is slow to import, so it is only loaded when needed
+    from multiprocessing import Pool, cpu_count
+    if jobs is None:
+        jobs = cpu_count()
+    errors = [0]
+
+    def emit(results):
+        for line_number, output, message in results:
+            if message is not None:
+                errors[0] += 1
+                error(line_number, message)
+            else:
+                write(output + '\n')
+
+    if jobs <= 1:
+        for batch in _batches(lines, batch_size):
+            emit(format_batch(batch, sort_keys, color))
+        return errors[0]
+
+    pool = Pool(jobs)
+    try:
+        pending = deque()
+        for batch in _batches(lines, batch_size):
+            if len(pending) >= 2 * jobs:
+                emit(pending.popleft().get())
+            pending.append(pool.apply_async(format_batch,
+                                            (batch, sort_keys, color)))
+        while pending:
+            emit(pending.popleft().get())
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return errors[0]
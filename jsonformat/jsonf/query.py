@@ -0,0 +1,222 @@
+"""
+Selection of parts of a document with a path, while it is streamed.
+
+Paths are a small subset of the ``jq`` syntax::
+
+    .                       the whole document
+    .items                  member "items" of an object
+    .["a key"]              member with any name
+    .items[0]               first item of an array
+    .items[*] or .items[]   every item of an array (or member of an object)
+    .items[*].metadata.name
+
+The document is walked along the path only: everything else is skipped by
+scanning for the end of each value, without decoding it. Only the selected
+values are formatted, each as a document of its own. Memory use and time to
+the first output thus depend on the selected values, not on the input.
+
+Parts of the input which are skipped are not validated beyond the nesting
+of brackets.
+"""
+import json
+import re
+
+from jsonf.stream import (PUNCTUATION, PLAIN_STRING, STRING, _VALUE, _KEY,
+                          _COLON, _COMMA_OR_CLOSE, _DONE, _WHITESPACE,
+                          _Reader, _formatter, _unexpected)
+
+# Steps of a path: a member name (str), an item index (int) or ``ALL``
+ALL = None
+
+_STEP = re.compile(r'''
+    \.([A-Za-z_][A-Za-z0-9_-]*)             # .name
+  | \.?\[\s*("(?:[^"\\]|\\.)*")\s*\]        # ["name"]
+  | \.?\[\s*([0-9]+)\s*\]                   # [0]
+  | (\.?\[\s*\*?\s*\]|\.\*)                 # [*], [] or .*
+''', re.VERBOSE)
+
+# An object key and the colon after it
+_MEMBER = re.compile(r'[ \t\r\n]*("[^"\\]*(?:\\.[^"\\]*)*")[ \t\r\n]*:')
+
+# A string, number or literal which is skipped. Not validated.
+_SCALAR = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[^ \t\r\n,:{}\[\]"]+')
+
+# Everything up to the next bracket or unterminated string
+_SKIP = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+
+
+def parse_path(text):
+    """
+    Returns the list of steps of the path *text*. Raises ``ValueError`` if
+    it is not valid.
+    """
+    text = text.strip()
+    if text == '.':
+        return []
+    steps = []
+    pos = 0
+    while pos < len(text):
+        found = _STEP.match(text, pos)
+        if found is None or (not pos and text[0] != '.'):
+            raise ValueError('Invalid path at %r' % text[pos:])
+        name, quoted, index, _ = found.groups()
+        if name is not None:
+            steps.append(name)
+        elif quoted is not None:
+            steps.append(json.loads(quoted))
+        elif index is not None:
+            steps.append(int(index))
+        else:
+            steps.append(ALL)
+        pos = found.end()
+    return steps
+
+
+def select_stream(chunks, path, write, sort_keys=True, indent=4):
+    """
+    Write the values at *path* (a string or a list of steps, see
+    :py:func:`parse_path`) in the JSON document read from the iterable
+    *chunks* to the callable *write*. Each value is formatted like
+    :py:func:`jsonf.stream.format_stream` does and followed by a line
+    break. Values which do not have the path are ignored.
+
+    Returns the number of values written.
+    """
+    if not isinstance(path, list):
+        path = parse_path(path)
+    format_value = _formatter(write, sort_keys, indent)
+    reader = _Reader(chunks)
+    count = _select(reader, path, format_value, write)
+    kind, text = reader.token()
+    if kind is not None:
+        raise _unexpected(text, _DONE)
+    return count
+
+
+def _select(reader, steps, format_value, write):
+    """
+    Write the values at *steps* below the value at the position of
+    *reader* and move past it. Returns the number of values written.
+
+    This recurses once per step, the depth of the document itself is
+    handled by :py:func:`_skip` and the formatter.
+    """
+    if not steps:
+        format_value(reader)
+        write('\n')
+        return 1
+    step = steps[0]
+    start = _peek(reader)
+    if start != '{' and start != '[':
+        _skip(reader)
+        return 0
+    if step is not ALL and isinstance(step, int) != (start == '['):
+        _skip(reader)
+        return 0
+
+    reader.pos += 1
+    closing = start == '{' and '}' or ']'
+    count = 0
+    index = 0
+    if _peek(reader) == closing:
+        reader.pos += 1
+        return 0
+    while True:
+        if closing == '}':
+            key = _key(reader)
+            selected = step is ALL or step == key
+        else:
+            selected = step is ALL or step == index
+            index += 1
+        if selected:
+            count += _select(reader, steps[1:], format_value, write)
+        else:
+            _skip(reader)
+        separator = _peek(reader)
+        reader.pos += 1
+        if separator == closing:
+            return count
+        if separator != ',':
+            raise _unexpected(separator or None, _COMMA_OR_CLOSE)
+        if closing == ']' and step is not ALL and index > step:
+            _skip(reader, 1)  # the rest of the array
+            return count
+
+
+def _peek(reader):
+    """
+    Move *reader* past whitespace and return the next character, or an
+    empty string at the end of the input.
+    """
+    while True:
+        buf = reader.buf
+        pos = _WHITESPACE.match(buf, reader.pos).end()
+        reader.pos = pos
+        if pos < len(buf) or reader.eof:
+            return buf[pos:pos + 1]
+        reader.more()
+
+
+def _key(reader):
+    """
+    Read an object key and the following ":". Returns the key.
+    """
+    found = _MEMBER.match(reader.buf, reader.pos)
+    if found is not None:
+        reader.pos = found.end()
+        text = found.group(1)
+    else:
+        # split over chunks, or invalid
+        kind, text = reader.token()
+        if kind != PLAIN_STRING and kind != STRING:
+            raise _unexpected(text, _KEY)
+        kind, colon = reader.token()
+        if kind != PUNCTUATION or colon != ':':
+            raise _unexpected(colon, _COLON)
+    if '\\' in text:
+        return json.loads(text)
+    return text[1:-1]
+
+
+def _skip(reader, depth=0):
+    """
+    Move *reader* past the value at its position, or with *depth* > 0, past
+    the end of the enclosing containers.
+    """
+    if not depth:
+        start = _peek(reader)
+        if not start:
+            raise ValueError('Unexpected end of the document')
+        if start != '{' and start != '[':
+            buf = reader.buf
+            found = _SCALAR.match(buf, reader.pos)
+            if found is not None and (found.end() < len(buf) or reader.eof):
+                reader.pos = found.end()
+                return
+            # split over chunks, or invalid
+            kind, text = reader.token()
+            if kind == PUNCTUATION:
+                raise _unexpected(text, _VALUE)
+            return
+        reader.pos += 1
+        depth = 1
+    while True:
+        buf = reader.buf
+        end = _SKIP.match(buf, reader.pos).end()
+        reader.pos = end
+        if end == len(buf):
+            if reader.eof:
+                raise ValueError('Unexpected end of the document')
+            reader.more(len(buf) - end)
+        elif buf[end] == '"':
+            if reader.eof:
+                raise reader.error(end)
+            reader._read_string(end)
+        else:
+            reader.pos = end + 1
+            if buf[end] in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if not depth:
+                    return
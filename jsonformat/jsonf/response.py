@@ -0,0 +1,291 @@
+"""
+Incremental reading of HTTP/1.x responses, as written by ``curl -i``.
+
+The input is read as bytes. If it starts with a status line, all header
+blocks are read: ``curl -i -L`` writes one per redirect, and there may be
+``100 Continue`` or proxy ``CONNECT`` responses before the final one. The
+body of the last response is then decoded on the fly:
+
+* ``Transfer-Encoding: chunked`` framing is removed (curl only keeps it
+  with ``--raw``),
+* ``Content-Encoding: gzip`` or ``deflate`` is decompressed with ``zlib``,
+  unless the body was already decompressed (``curl --compressed`` keeps the
+  header),
+* the text is decoded as UTF-8, the encoding of JSON.
+
+Every step works on pieces of at most ``CHUNK_SIZE`` bytes, so the body is
+never held in memory as a whole.
+"""
+import codecs
+import re
+import zlib
+
+from jsonf.stream import CHUNK_SIZE
+
+#: Longest accepted status or header line, in bytes
+MAX_LINE = 64 * 1024
+
+_CHUNK_SIZE_LINE = re.compile(br'[0-9a-fA-F]+[ \t]*(?:;[^\r\n]*)?\r?\n')
+_GZIP_MAGIC = b'\x1f\x8b'
+# the first byte of a JSON document, after white space
+_JSON_START = b'{["-0123456789tfn'
+
+
+class _Input(object):
+    """
+    A buffer over the binary file-like object *stream*, which can read
+    lines and look ahead.
+    """
+    __slots__ = ('stream', 'size', 'buf', 'eof')
+
+    def __init__(self, stream, size=CHUNK_SIZE):
+        self.stream = stream
+        self.size = size
+        self.buf = b''
+        self.eof = False
+
+    def _fill(self):
+        data = self.stream.read(self.size)
+        if not data:
+            self.eof = True
+        self.buf += data
+
+    def peek(self, count):
+        """
+        Return the next *count* bytes (or fewer at the end of the input)
+        without consuming them.
+        """
+        while len(self.buf) < count and not self.eof:
+            self._fill()
+        return self.buf[:count]
+
+    def readline(self):
+        """
+        Return the next line, with its line ending. Raises ``ValueError`` if
+        it is longer than ``MAX_LINE``.
+        """
+        start = 0
+        while True:
+            end = self.buf.find(b'\n', start)
+            if end >= 0:
+                line, self.buf = self.buf[:end + 1], self.buf[end + 1:]
+                return line
+            if self.eof:
+                line, self.buf = self.buf, b''
+                return line
+            if len(self.buf) > MAX_LINE:
+                raise ValueError('Line too long in the HTTP headers')
+            start = len(self.buf)
+            self._fill()
+
+    def read(self, count=None):
+        """
+        Return at most *count* (default: ``size``) bytes, an empty string at
+        the end of the input.
+        """
+        if not self.buf and not self.eof:
+            self._fill()
+        count = count or self.size
+        data, self.buf = self.buf[:count], self.buf[count:]
+        return data
+
+
+def read_response(stream, size=CHUNK_SIZE):
+    """
+    Read the HTTP headers (if any) from the beginning of the binary
+    file-like object *stream*.
+
+    Returns a tuple ``(headers, chunks)`` where *headers* is the list of
+    header lines of all responses, separated by blank lines (empty if the
+    stream does not start with an HTTP status line), and *chunks* iterates
+    over the decoded text of the body.
+    """
+    input = _Input(stream, size)
+    start = input.peek(5)
+    if start != b'HTTP/':
+        # a body saved without headers, unless it starts like JSON
+        pieces = _read_all(input)
+        if start[:2] == _GZIP_MAGIC:
+            pieces = _decompress(pieces, 'gzip')
+        elif _is_zlib(start):
+            pieces = _decompress(pieces, 'deflate')
+        return [], _decode_text(pieces)
+
+    headers = []
+    while True:
+        fields = {}
+        line = input.readline()
+        headers.append(line.decode('latin-1'))
+        for line in iter(input.readline, b''):
+            if not line.strip():
+                break
+            headers.append(line.decode('latin-1'))
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if name in fields:
+                fields[name] += ', ' + value.strip()
+            else:
+                fields[name] = value.strip()
+        if input.peek(5) != b'HTTP/':
+            break
+        headers.append(line.decode('latin-1'))  # the blank line
+
+    pieces = _read_all(input)
+    transfer = _codings(fields.get('transfer-encoding', ''))
+    if transfer[-1:] == ['chunked']:
+        if _CHUNK_SIZE_LINE.match(input.peek(80)):
+            pieces = _dechunk(input)
+        elif fields.get('trailer'):
+            # decoded by curl, which writes the trailer fields right after
+            # the body
+            pieces = _strip_trailers(pieces, fields['trailer'].split(','))
+    for coding in reversed(_codings(fields.get('content-encoding', ''))):
+        pieces = _decompress(pieces, coding)
+    return headers, _decode_text(pieces)
+
+
+def _codings(value):
+    return [coding.strip().lower() for coding in value.split(',')
+            if coding.strip() and coding.strip().lower() != 'identity']
+
+
+def _read_all(input):
+    return iter(input.read, b'')
+
+
+def _dechunk(input):
+    """
+    Yield the data of the chunks of a ``Transfer-Encoding: chunked`` body.
+    """
+    while True:
+        line = input.readline()
+        if not _CHUNK_SIZE_LINE.match(line):
+            raise ValueError('Invalid chunk size line: %r' % line[:80])
+        remaining = int(line.split(b';')[0].strip(), 16)
+        if not remaining:
+            break
+        while remaining:
+            data = input.read(min(remaining, input.size))
+            if not data:
+                raise ValueError('Unexpected end of a chunk')
+            remaining -= len(data)
+            yield data
+        if input.readline().strip():
+            raise ValueError('Missing line break after a chunk')
+    # trailer fields
+    for line in iter(input.readline, b''):
+        if not line.strip():
+            break
+
+
+def _strip_trailers(pieces, names):
+    """
+    Pass on the bytes from the iterable *pieces*, without the header fields
+    called *names* at the end.
+    """
+    names = b'|'.join(re.escape(name.strip().encode('latin-1'))
+                      for name in names)
+    trailers = re.compile(br'(?:(?:' + names + br'):[^\r\n]*\r?\n)+\Z',
+                          re.IGNORECASE)
+    tail = b''
+    for data in pieces:
+        tail += data
+        # the last MAX_LINE bytes are held back: the trailers may start
+        # in one piece and end in the next
+        if len(tail) > 2 * MAX_LINE:
+            yield tail[:-MAX_LINE]
+            tail = tail[-MAX_LINE:]
+    found = trailers.search(tail)
+    if found is not None:
+        tail = tail[:found.start()]
+    yield tail
+
+
+def _looks_like_json(data):
+    first = data.lstrip()[:1]
+    return bool(first) and first in _JSON_START
+
+
+def _is_zlib(data):
+    # "8" passes the header check ("80" is a valid zlib header), but a
+    # number does not decompress anyway
+    if _looks_like_json(data):
+        return False
+    header = bytearray(data[:2])
+    return (len(header) == 2 and header[0] & 0x0f == 8 and
+            (header[0] << 8 | header[1]) % 31 == 0)
+
+
+def _decompress(pieces, coding):
+    """
+    Decompress the bytes from the iterable *pieces* with the content coding
+    *coding*. Bodies which are not compressed are passed through.
+    """
+    pieces = iter(pieces)
+    first = b''
+    for first in pieces:
+        if first:
+            break
+    if coding in ('gzip', 'x-gzip'):
+        if first[:2] != _GZIP_MAGIC:
+            wbits = None
+        else:
+            wbits = 16 + zlib.MAX_WBITS
+    elif coding == 'deflate':
+        # "deflate" is meant to be zlib wrapped, but some servers send raw
+        # deflate data. A body starting like JSON has been decoded already.
+        if _is_zlib(first):
+            wbits = zlib.MAX_WBITS
+        elif not first.strip() or _looks_like_json(first):
+            wbits = None
+        else:
+            wbits = -zlib.MAX_WBITS
+    else:
+        raise ValueError('Unsupported Content-Encoding: %s' % coding)
+
+    if wbits is None:
+        yield first
+        for data in pieces:
+            yield data
+        return
+
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        for data in _chain_first(first, pieces):
+            while data:
+                # limit the output, a small input may expand a lot
+                yield decompressor.decompress(data, CHUNK_SIZE)
+                data = decompressor.unused_data
+                if not data:
+                    data = decompressor.unconsumed_tail
+                elif wbits > 0 and data[:2] == _GZIP_MAGIC:
+                    # concatenated gzip members
+                    decompressor = zlib.decompressobj(wbits)
+                else:
+                    # the end of the compressed data. What follows are the
+                    # trailer fields curl writes after a chunked body.
+                    return
+        yield decompressor.flush()
+    except zlib.error as exc:
+        raise ValueError('Invalid %s data: %s' % (coding, exc))
+
+
+def _chain_first(first, pieces):
+    yield first
+    for data in pieces:
+        yield data
+
+
+def _decode_text(pieces):
+    """
+    Decode UTF-8 (with or without byte order mark) from the iterable of
+    bytes *pieces*.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    for data in pieces:
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b'', True)
+    if text:
+        yield text
@@ -0,0 +1,310 @@
+"""
+Formatting server, for tools which format many documents.
+
+Starting ``jsonf`` for each document costs more than formatting a small one.
+``jsonf --serve SOCKET`` keeps a warm formatter running instead and listens
+on the Unix socket *SOCKET*. With ``--serve -``, it reads requests from
+stdin and writes the responses to stdout, for editors which start it as a
+child process.
+
+Requests and responses are frames: the length of the payload as a 4 byte
+unsigned big endian integer, followed by the payload. A request payload is a
+JSON document (UTF-8). The response payload starts with ``+`` followed by
+the formatted document, or with ``-`` followed by an error message. The
+server options (``--unsorted``, ``--color=always``, ``--path``) apply to all
+requests. Clients may send many requests on one connection, each response
+is sent before the next request is read.
+
+Many clients can be connected at once. Their requests wait in a bounded
+queue for the formatter, so a burst of requests slows the clients down
+instead of piling up in memory. The latency of each request is logged on
+stderr, a summary is logged on shutdown.
+
+A socket left behind by a killed server is replaced. Anything else at the
+*SOCKET* path, including the socket of a running server, is left alone and
+the server exits with an error.
+
+Requires Python 3.7 or later, see :py:func:`send_request` for a client.
+"""
+import asyncio
+import errno
+import logging
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jsonf.color import colorize
+from jsonf.query import select_stream
+from jsonf.stream import _DONE, _Reader, _formatter, _unexpected
+
+LOG = logging.getLogger(__name__)
+
+#: Requests waiting for the formatter. Clients are not read while it is full.
+QUEUE_SIZE = 64
+
+#: Largest accepted request payload, in bytes
+MAX_REQUEST = 256 * 1024 * 1024
+
+_LENGTH = struct.Struct('>I')
+
+
+class _Formatter(object):
+    """
+    Formats request payloads. Created once and only used from the single
+    formatting thread, so its state is reused for all requests.
+    """
+
+    def __init__(self, sort_keys=True, color=False, path=None):
+        self.sort_keys = sort_keys
+        self.color = color
+        self.path = path
+        self.pieces = []
+        self.format_value = _formatter(self.pieces.append, sort_keys)
+
+    def __call__(self, payload):
+        """
+        Returns the response payload for the request *payload*.
+        """
+        del self.pieces[:]
+        try:
+            text = payload.decode('utf-8-sig')
+            if self.path is not None:
+                select_stream([text], self.path, self.pieces.append,
+                              self.sort_keys)
+            else:
+                reader = _Reader([text])
+                self.format_value(reader)
+                kind, token = reader.token()
+                if kind is not None:
+                    raise _unexpected(token, _DONE)
+        except ValueError as exc:
+            return b'-' + str(exc).encode('utf8')
+        output = ''.join(self.pieces)
+        del self.pieces[:]
+        if self.color:
+            output = colorize(output)
+        return b'+' + output.encode('utf8')
+
+
+class _Stats(object):
+    """
+    Latencies of the handled requests, in seconds.
+    """
+
+    def __init__(self):
+        self.latencies = []
+
+    def add(self, number, size, waited, total):
+        self.latencies.append(total)
+        LOG.info('request %d: %d bytes, %.2f ms (%.2f ms queued)',
+                 number, size, total * 1000, waited * 1000)
+
+    def summary(self):
+        if not self.latencies:
+            return 'no requests'
+        latencies = sorted(self.latencies)
+
+        def percentile(value):
+            return latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * value))] * 1000
+
+        return '%d requests, latency p50 %.2f ms, p90 %.2f ms, ' \
+            'p99 %.2f ms, max %.2f ms' % (
+                len(latencies), percentile(0.5), percentile(0.9),
+                percentile(0.99), latencies[-1] * 1000)
+
+
+class Server(object):
+    """
+    The request queue and the formatter behind it. Connections are handled
+    with :py:meth:`handle`.
+    """
+
+    def __init__(self, formatter, queue_size=QUEUE_SIZE):
+        self.formatter = formatter
+        self.queue = asyncio.Queue(queue_size)
+        self.stats = _Stats()
+        self.requests = 0
+        # one thread: the formatter is not thread safe, and the event loop
+        # keeps serving the connections while it runs
+        self.executor = ThreadPoolExecutor(1)
+
+    async def work(self):
+        """
+        Format the queued requests, one at a time.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            payload, future = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(
+                    self.executor, self.formatter, payload)
+            except Exception as exc:
+                LOG.exception('Formatting failed')
+                response = b'-' + str(exc).encode('utf8')
+            if not future.cancelled():
+                future.set_result((response, started))
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests coming from *reader* on *writer* until the
+        client closes the connection.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_LENGTH.size)
+                except asyncio.IncompleteReadError:
+                    break
+                received = time.perf_counter()
+                length, = _LENGTH.unpack(header)
+                if length > MAX_REQUEST:
+                    await self._respond(writer, b'-Request too large')
+                    break
+                payload = await reader.readexactly(length)
+                self.requests += 1
+                number = self.requests
+                future = loop.create_future()
+                await self.queue.put((payload, future))
+                response, started = await future
+                await self._respond(writer, response)
+                self.stats.add(number, length, started - received,
+                               time.perf_counter() - received)
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            LOG.warning('Connection lost: %s', exc)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, response):
+        writer.write(_LENGTH.pack(len(response)) + response)
+        await writer.drain()
+
+
+def _remove_stale_socket(path):
+    """
+    Remove the socket *path* left behind by a server which was killed.
+    Raises ``OSError`` if *path* is not a socket, or if a server still
+    accepts connections on it.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, 'Not a socket, refusing to replace it',
+                      path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, 'A server is already running', path)
+
+
+async def _serve_socket(server, path):
+    listener = await asyncio.start_unix_server(server.handle, path)
+    LOG.info('Listening on %s', path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        listener.close()
+        await listener.wait_closed()
+        os.unlink(path)
+
+
+async def _serve_stdio(server):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, sys.stdout.buffer)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    await server.handle(reader, writer)
+
+
+async def _main(address, formatter, queue_size):
+    server = Server(formatter, queue_size)
+    worker = asyncio.ensure_future(server.work())
+    try:
+        if address == '-':
+            await _serve_stdio(server)
+        else:
+            await _serve_socket(server, address)
+    finally:
+        worker.cancel()
+        server.executor.shutdown()
+        LOG.info('%s', server.stats.summary())
+
+
+def serve(address, sort_keys=True, color=False, path=None,
+          queue_size=QUEUE_SIZE):
+    """
+    Run the server on the Unix socket *address*, or on stdin and stdout if
+    *address* is ``'-'``, until it is interrupted (or stdin is closed).
+    Returns the exit status.
+    """
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='jsonf: %(message)s')
+    formatter = _Formatter(sort_keys, color, path)
+    try:
+        if address != '-':
+            _remove_stale_socket(address)
+        asyncio.run(_main(address, formatter, queue_size))
+    except KeyboardInterrupt:
+        pass
+    except OSError as exc:
+        LOG.error('%s', exc)
+        return 1
+    return 0
+
+
+def send_request(sock, document):
+    """
+    Send the JSON document *document* (bytes) to the server on the
+    connected Unix socket *sock* and wait for the answer.
+
+    Returns the formatted document as bytes. Raises ``ValueError`` with the
+    message of the server if the document is not valid.
+    """
+    sock.sendall(_LENGTH.pack(len(document)) + document)
+    length, = _LENGTH.unpack(_receive(sock, _LENGTH.size))
+    response = _receive(sock, length)
+    if response[:1] != b'+':
+        raise ValueError(response[1:].decode('utf8'))
+    return response[1:]
+
+
+def connect(path):
+    """
+    Returns a socket connected to the server listening on *path*.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+def _receive(sock, size):
+    parts = []
+    while size:
+        data = sock.recv(min(size, 1024 * 1024))
+        if not data:
+            raise ConnectionError('Connection closed by the server')
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
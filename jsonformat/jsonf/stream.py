@@ -0,0 +1,482 @@
+"""
+Streaming JSON re-indenter.
+
+The input is read in chunks and the indented output is produced as soon as
+possible, so memory use does not depend on the size of the document but only
+on its nesting depth. The only exception are sorted keys: an object has to be
+kept (as formatted text) until it is closed before its members can be
+written in order.
+
+Splitting the whole document into tokens in Python is several times slower
+than the C accelerated ``json`` module. So values are decoded and re-encoded
+with ``json`` as a whole as long as they are smaller than ``DECODE_LIMIT``,
+items of arrays in batches. Only larger containers, and values nested too
+deep for ``json``, are walked token by token with an explicit stack, which
+keeps memory bounded and allows any nesting depth.
+
+Numbers are copied from the input as they are, so they keep their precision
+and notation (``1.10``, ``1E400``). Integers survive ``int`` unchanged, except
+for ``-0``. The decoder is made to return the other numbers as strings,
+marked to be told apart from real strings (see ``_NUMBER_MARK``).
+"""
+import json
+import re
+import sys
+from collections import OrderedDict
+
+#: Number of characters read from the input at once
+CHUNK_SIZE = 64 * 1024
+
+#: Containers up to this size (in characters) are formatted with ``json``
+DECODE_LIMIT = 256 * 1024
+
+# Line breaks with the indentation of up to this depth are kept
+_NEWLINE_CACHE = 256
+
+# Decoded numbers are strings starting with this character, which is encoded
+# as "\u0000". Input containing that escape is never decoded, so strings in
+# the output starting with it are numbers.
+_NUMBER_MARK = u'\x00'
+_MARKED_NUMBER = re.compile(r'"\\u0000([^"]*)"')
+
+#: Token kinds, see :py:meth:`_Reader.token`. ``PLAIN_STRING`` tokens are
+#: written by ``json.dumps`` exactly as they appear in the input, numbers are
+#: always copied as they are.
+PUNCTUATION, PLAIN_STRING, STRING, INTEGER, NUMBER, LITERAL = range(1, 7)
+_INVALID = 7
+_NUMBERS = (INTEGER, NUMBER)
+
+if sys.version_info >= (3, 4):
+    ITEM_SEPARATOR = ','
+else:
+    # Older versions of ``json.dumps`` keep the space after the comma when
+    # indenting.
+    ITEM_SEPARATOR = ', '
+
+_TOKEN = re.compile(r'''
+    [ \t\r\n]*
+    (?:
+        ([{}\[\]:,])                                            # punctuation
+      | ("[ !#-\[\]-~]*")                                        # plain string
+      | ("[^"\\]*(?:\\.[^"\\]*)*")                               # string
+      | (0|-?[1-9][0-9]*)(?![.eE0-9])                           # integer
+      | (-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)  # number
+      | (true|false|null)                                       # literal
+      | ([^ \t\r\n])      # invalid, or a token continued in the next chunk
+    )''', re.VERBOSE | re.DOTALL)
+
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+# Tokens which may continue in the next chunk if they end the buffer. Strings
+# are not listed, they are recognized by their opening quote.
+_PARTIAL = re.compile(r'(?:t(?:r(?:ue?)?)?|f(?:a(?:l(?:se?)?)?)?|n(?:u(?:ll?)?)?'
+                      r'|-)\Z')
+
+# What may follow a number which continues in the next chunk, up to the end
+# of the buffer.
+_NUMBER_TAIL = re.compile(r'[.eE+\-]*\Z')
+
+# Parser states
+(_VALUE, _VALUE_OR_CLOSE, _KEY, _KEY_OR_CLOSE, _COLON, _COMMA_OR_CLOSE,
+ _DONE) = range(7)
+
+_EXPECTED = {
+    _VALUE: 'a value',
+    _VALUE_OR_CLOSE: 'a value or "]"',
+    _KEY: 'an object key',
+    _KEY_OR_CLOSE: 'an object key or "}"',
+    _COLON: '":"',
+    _COMMA_OR_CLOSE: '"," or the end of the container',
+}
+
+
+def read_chunks(stream, size=CHUNK_SIZE):
+    """
+    Yield the contents of the file-like object *stream* in pieces of at most
+    *size* characters.
+    """
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Reader(object):
+    """
+    The input of the formatter: a window on the text coming from the iterable
+    *chunks*. Only the text from ``pos`` on is kept.
+    """
+    __slots__ = ('chunks', 'buf', 'pos', 'offset', 'eof')
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0  # position of *buf* in the input
+        self.eof = False
+
+    def more(self, size=1):
+        """
+        Read at least *size* more characters, unless the input ends first.
+        """
+        parts = [self.buf[self.pos:]]
+        missing = max(size, 1)
+        while missing > 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                break
+            parts.append(chunk)
+            missing -= len(chunk)
+        self.offset += self.pos
+        self.buf = ''.join(parts)
+        self.pos = 0
+
+    def error(self, position):
+        return ValueError('Invalid JSON at offset %d' % (
+            self.offset + position))
+
+    def token(self):
+        """
+        Return the next token as a ``(kind, text)`` tuple where *kind* is one
+        of ``PUNCTUATION``, ``PLAIN_STRING`` (printable ASCII without
+        escapes), ``STRING``, ``INTEGER``, ``NUMBER`` or ``LITERAL`` and
+        *text* is the token as it appears in the input. Returns ``(None,
+        None)`` at the end of the input.
+        """
+        while True:
+            buf = self.buf
+            found = _TOKEN.match(buf, self.pos)
+            if found is None:
+                # only whitespace left
+                if self.eof:
+                    return None, None
+            else:
+                kind = found.lastindex
+                end = found.end()
+                if kind != _INVALID and (
+                        self.eof or kind not in _NUMBERS or
+                        end + 2 < len(buf) or
+                        not _NUMBER_TAIL.match(buf, end)):
+                    self.pos = end
+                    return kind, found.group(kind)
+                start = found.start(kind)
+                if self.eof or (kind == _INVALID and buf[start] != '"' and
+                                not _PARTIAL.match(buf, start)):
+                    raise self.error(start)
+                if buf[start] == '"':
+                    self._read_string(start)
+                    continue
+            # double the buffer, so long tokens are read in linear time
+            self.more(len(buf) - self.pos)
+
+    def _read_string(self, start):
+        """
+        Read on until the string starting at *start* is complete. Cheaper
+        than matching the whole string again after every chunk.
+        """
+        scanned = start + 1
+        while not self.eof:
+            buf = self.buf
+            end = buf.find('"', scanned)
+            if end < 0:
+                scanned = len(buf) - self.pos
+                self.more(len(buf) - self.pos)
+                continue
+            escape = end
+            while buf[escape - 1] == '\\':
+                escape -= 1
+            if (end - escape) % 2 == 0:
+                return
+            scanned = end + 1
+
+
+def _decode_values(reader, raw_decode, items):
+    """
+    Decode the value at the position of *reader* with *raw_decode* and move
+    past it. With *items* (inside of arrays), the following items are
+    decoded too, as long as they are already in the buffer.
+
+    Returns a tuple ``(values, comma, start)``: the list of decoded values,
+    whether the "," after the last one has been consumed and the position of
+    the first value in ``reader.buf``. Values which are invalid or larger
+    than ``DECODE_LIMIT`` are left for the tokenizer, as are scalars outside
+    of arrays. *values* is ``None`` if the next value is nested too deep to
+    be decoded.
+    """
+    values = []
+    comma = False
+    first = None
+    while True:
+        buf = reader.buf
+        start = _WHITESPACE.match(buf, reader.pos).end()
+        if first is None:
+            first = start
+        if start < len(buf):
+            if buf[start] in ']},:' or (not items and buf[start] not in '{['):
+                return values, comma, first
+            try:
+                value, end = raw_decode(buf, start)
+            except ValueError:
+                end = None
+            except RuntimeError:
+                # RecursionError
+                return values or None, comma, first
+            # the text after the value shows that it is complete (a number
+            # at the end of the buffer may continue in the next chunk)
+            if end is not None and (reader.eof or
+                                    not _NUMBER_TAIL.match(buf, end)) and (
+                                        buf.find('\\u0000', start, end) < 0):
+                values.append(value)
+                reader.pos = end
+                comma = False
+                if not items:
+                    return values, comma, first
+                end = _WHITESPACE.match(buf, end).end()
+                if end < len(buf) and buf[end] == ',':
+                    reader.pos = end + 1
+                    comma = True
+                    continue
+                return values, comma, first
+        if values or reader.eof or len(buf) - start >= DECODE_LIMIT:
+            return values, comma, first
+        reader.pos = start
+        first = None
+        reader.more(len(buf) - start)
+
+
+def format_stream(chunks, write, sort_keys=True, indent=4):
+    """
+    Write the JSON document read from the iterable *chunks* with the layout
+    of ``json.dumps(json.loads(text), sort_keys=sort_keys, indent=indent)``
+    to the callable *write*. Unlike with ``json``, numbers are written
+    exactly as they appear in the input.
+
+    Output is written in pieces while the input is read. Without
+    *sort_keys*, members keep their original order and memory use is
+    bounded by the nesting depth and ``DECODE_LIMIT``. In that case, and
+    unlike with ``json``, duplicate keys of objects larger than the limit
+    are all kept. Raises ``ValueError`` if the input is not exactly one JSON
+    document.
+    """
+    reader = _Reader(chunks)
+    _formatter(write, sort_keys, indent)(reader)
+    kind, text = reader.token()
+    if kind is not None:
+        raise _unexpected(text, _DONE)
+
+
+def _formatter(write, sort_keys=True, indent=4):
+    """
+    Returns a function ``format_value(reader)`` which formats the next value
+    of the :py:class:`_Reader` *reader* like :py:func:`format_stream` and
+    leaves the reader right after it.
+    """
+    # numbers are kept as marked strings, without a Python function call
+    mark = _NUMBER_MARK.__add__
+    hook = None
+    if not sort_keys and sys.version_info < (3, 7):
+        hook = OrderedDict
+    # integers are only marked where "-0" could lose its sign
+    decode = json.JSONDecoder(parse_float=mark,
+                              object_pairs_hook=hook).raw_decode
+    decode_exact = json.JSONDecoder(parse_float=mark, parse_int=mark,
+                                    object_pairs_hook=hook).raw_decode
+
+    def raw_decode(text, start):
+        value, end = decode(text, start)
+        if text.find('-0', start, end) >= 0:
+            value, end = decode_exact(text, start)
+        return value, end
+
+    encoder = json.JSONEncoder(sort_keys=sort_keys, indent=indent)
+    # the text between the marked numbers, and the numbers themselves
+    split_marked = _MARKED_NUMBER.split
+
+    def encode(value):
+        text = encoder.encode(value)
+        if '\\u0000' in text:
+            text = ''.join(split_marked(text))
+        return text
+
+    newlines = ['\n']
+
+    def newline(depth):
+        if depth >= _NEWLINE_CACHE:
+            # as long as the line itself
+            return '\n' + ' ' * (indent * depth)
+        while len(newlines) <= depth:
+            newlines.append('\n' + ' ' * (indent * len(newlines)))
+        return newlines[depth]
+
+    def format_value(reader):
+        _format_value(reader, write, raw_decode, encode, newline, sort_keys)
+
+    return format_value
+
+
+def _format_value(reader, write, raw_decode, encode, newline, sort_keys):
+    """
+    The formatter behind :py:func:`_formatter`.
+    """
+    root = out = []
+    # The state of the enclosing containers: (in_object, count, out,
+    # members) tuples.
+    stack = []
+    in_object = False
+    count = 0       # number of items in the current container
+    members = None  # sorted objects: key -> output of the value
+    depth = 0
+    nl = newline(0)  # line break and indentation of the current items
+    separator = ITEM_SEPARATOR
+    expect = _VALUE
+    # Values are not decoded at this depth and deeper, after one has been
+    # nested too deep for ``json``. Reset when its container is closed.
+    tokens_from = None
+
+    while True:
+        if ((expect == _VALUE or expect == _VALUE_OR_CLOSE) and
+                tokens_from is None):
+            in_array = depth and not in_object
+            values, comma, start = _decode_values(reader, raw_decode,
+                                                  in_array)
+            if values:
+                try:
+                    if in_array:
+                        # the items without the brackets
+                        text = encode(values)[1:-2]
+                    else:
+                        text = encode(values[0])
+                except RuntimeError:
+                    # RecursionError, the encoder is recursive in Python
+                    values = None
+                    reader.pos = start
+            if values is None:
+                tokens_from = depth
+            elif values:
+                if in_array:
+                    # indented one level less than in their own list
+                    out.append((count and separator or '') +
+                               text.replace('\n', newline(depth - 1)))
+                    count += len(values)
+                    expect = _COMMA_OR_CLOSE
+                    if comma:
+                        expect = _VALUE
+                elif depth:
+                    out.append(text.replace('\n', nl))
+                    expect = _COMMA_OR_CLOSE
+                else:
+                    out.append(text)
+                    expect = _DONE
+                # decoded values come in large pieces, don't keep them
+                if out is root:
+                    write(''.join(root))
+                    del root[:]
+                if expect == _DONE:
+                    return
+                continue
+
+        kind, text = reader.token()
+        if kind is None:
+            break
+        if kind == PUNCTUATION:
+            if text == ',':
+                if expect != _COMMA_OR_CLOSE:
+                    raise _unexpected(text, expect)
+                expect = in_object and _KEY or _VALUE
+                continue
+            if text == ':':
+                if expect != _COLON:
+                    raise _unexpected(text, expect)
+                expect = _VALUE
+                continue
+            if text == '{' or text == '[':
+                if expect != _VALUE and expect != _VALUE_OR_CLOSE:
+                    raise _unexpected(text, expect)
+                if depth and not in_object:
+                    count += 1
+                    out.append(count > 1 and separator + nl or nl)
+                stack.append((in_object, count, out, members))
+                depth += 1
+                nl = newline(depth)
+                count = 0
+                if text == '{':
+                    in_object = True
+                    expect = _KEY_OR_CLOSE
+                    if sort_keys:
+                        members = {}
+                        continue
+                else:
+                    in_object = False
+                    expect = _VALUE_OR_CLOSE
+                members = None
+                out.append(text)
+                if depth >= _NEWLINE_CACHE and out is root:
+                    # each line is large
+                    write(''.join(root))
+                    del root[:]
+                continue
+
+            if text != (in_object and '}' or ']') or expect not in (
+                    _COMMA_OR_CLOSE, _KEY_OR_CLOSE, _VALUE_OR_CLOSE):
+                raise _unexpected(text, expect)
+            depth -= 1
+            if tokens_from is not None and depth < tokens_from:
+                tokens_from = None
+            closing_members = members
+            in_object, count, out, members = stack.pop()
+            if closing_members:
+                out.append('{')
+                item_separator = ''
+                for key in sorted(closing_members):
+                    out.append(item_separator + nl + json.dumps(key) + ': ')
+                    out.extend(closing_members[key])
+                    item_separator = separator
+                out.append(newline(depth) + '}')
+            elif closing_members is not None:
+                out.append('{}')
+            elif expect == _COMMA_OR_CLOSE:
+                out.append(newline(depth) + text)
+            else:
+                out.append(text)
+            nl = newline(depth)
+        elif expect == _KEY or expect == _KEY_OR_CLOSE:
+            if kind != PLAIN_STRING and kind != STRING:
+                raise _unexpected(text, expect)
+            count += 1
+            if members is not None:
+                out = members[json.loads(text)] = []
+            else:
+                if kind == STRING:
+                    text = json.dumps(json.loads(text))
+                out.append((count > 1 and separator + nl or nl) + text +
+                           ': ')
+            expect = _COLON
+            continue
+        else:
+            if expect != _VALUE and expect != _VALUE_OR_CLOSE:
+                raise _unexpected(text, expect)
+            if depth and not in_object:
+                count += 1
+                out.append(count > 1 and separator + nl or nl)
+            if kind == STRING:
+                text = json.dumps(json.loads(text))
+            out.append(text)
+
+        # a value has been completed
+        if not depth:
+            write(''.join(root))
+            return
+        expect = _COMMA_OR_CLOSE
+        if len(root) > 1024 or depth >= _NEWLINE_CACHE:
+            write(''.join(root))
+            del root[:]
+
+    raise ValueError('Unexpected end of the document')
+
+
+def _unexpected(text, expect):
+    if expect == _DONE:
+        return ValueError('Extra data after the document: %r' % text)
+    return ValueError('Expected %s, got %r' % (_EXPECTED[expect], text))
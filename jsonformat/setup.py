@@ -10,9 +10,9 @@ setup(
     license="BSD",
     url="https://github.com/exhuma/braindump/tree/master/jsonformat",
     include_package_data=True,
-    install_requires=[
-        "pygments"
-    ],
+    extras_require={
+        "pygments": ["pygments"]
+    },
     entry_points={
         'console_scripts': [
                 'jsonf = jsonf.cli:main'
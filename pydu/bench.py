@@ -0,0 +1,502 @@
+#!/usr/bin/python
+"""
+Benchmark harness for pydu
+
+Generates reproducible synthetic trees (see SHAPES) in a temporary folder
+and sizes each of them with every walker mode (see MODES). For every
+combination it reports:
+
+* files/s, from the best of a few runs on a warm page cache
+* the time of one run on a cold page cache (needs permission to write to
+  /proc/sys/vm/drop_caches, otherwise "n/a")
+* the number of syscalls (needs "strace", otherwise "n/a")
+* the peak RSS of the process running the walk
+
+Each run happens in a fresh subprocess, so the RSS and syscall numbers are
+not distorted by earlier runs. Before timing, "check_backends" verifies that
+all walker backends return the same results for the tree. With --check,
+only this verification is done, on small trees of every shape
+(CHECK_FILES files each), and the exit status tells whether it passed.
+
+The results can be saved as JSON with --output and compared with an earlier
+run with --compare, to spot regressions between revisions.
+
+With --mounts, mount point lookups are measured against a synthetic
+"/proc/mounts" with MOUNT_COUNT entries, comparing "MountIndex" with the old
+linear scan.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+from os.path import join, getsize, abspath, dirname
+
+sys.path.insert(0, dirname(abspath(__file__)))
+import pydu
+
+MOUNT_COUNT = 10000
+CHECK_FILES = 1000
+PARALLEL_JOBS = 4
+SEED = 42
+
+
+def _write(path, size):
+   with open(path, "wb") as fptr:
+      fptr.write(b"x" * size)
+
+
+def make_wide(root, files, rng):
+   """
+   One level of many folders with a few files each
+   """
+   for i in range(0, files, 10):
+      folder = join(root, "w%06d" % i)
+      os.mkdir(folder)
+      for j in range(min(10, files - i)):
+         _write(join(folder, "f%d" % j), rng.randint(0, 8192))
+
+
+def make_deep(root, files, rng):
+   """
+   A chain of nested folders, a few files on every level
+   """
+   folder = root
+   for i in range(0, files, 5):
+      folder = join(folder, "d")
+      os.mkdir(folder)
+      for j in range(min(5, files - i)):
+         _write(join(folder, "f%d" % j), rng.randint(0, 8192))
+
+
+def make_tiny(root, files, rng):
+   """
+   Many tiny files in folders of 1000 files each (think node_modules)
+   """
+   for i in range(files):
+      if i % 1000 == 0:
+         folder = join(root, "t%06d" % i)
+         os.mkdir(folder)
+      _write(join(folder, "f%d" % i), rng.randint(0, 100))
+
+
+def make_hardlinks(root, files, rng):
+   """
+   Half of the files are hard links to files in another folder
+   """
+   os.mkdir(join(root, "data"))
+   os.mkdir(join(root, "links"))
+   originals = []
+   for i in range(files // 2):
+      path = join(root, "data", "f%d" % i)
+      _write(path, rng.randint(0, 8192))
+      originals.append(path)
+   for i in range(files - len(originals)):
+      os.link(rng.choice(originals), join(root, "links", "l%d" % i))
+
+
+def make_symlinks(root, files, rng):
+   """
+   Nested folders with symlink loops pointing back up the tree
+   """
+   for i in range(0, files, 20):
+      folder = join(root, "s%06d" % i, "inner")
+      os.makedirs(folder)
+      os.symlink("..", join(folder, "loop"))
+      os.symlink(root, join(folder, "root"))
+      for j in range(min(20, files - i)):
+         _write(join(folder, "f%d" % j), rng.randint(0, 8192))
+
+
+def make_unreadable(root, files, rng):
+   """
+   Like "wide", but every tenth folder cannot be read (unless the benchmark
+   runs as root)
+   """
+   make_wide(root, files, rng)
+   for i, name in enumerate(sorted(os.listdir(root))):
+      if i % 10 == 0:
+         os.chmod(join(root, name), 0)
+
+
+SHAPES = {
+   "wide": make_wide,
+   "deep": make_deep,
+   "tiny": make_tiny,
+   "hardlinks": make_hardlinks,
+   "symlinks": make_symlinks,
+   "unreadable": make_unreadable,
+}
+
+
+def make_tree(shape, files):
+   """
+   Create a tree of the given <shape> with <files> files in a new temporary
+   folder and return its path. The same arguments always give the same tree.
+   """
+   root = tempfile.mkdtemp(prefix="pydu-bench-%s-" % shape)
+   SHAPES[shape](root, files, random.Random(SEED))
+   # The size cache ignores folders modified in the last seconds
+   old = time.time() - 60
+   for folder, dirs, _ in os.walk(root):
+      for name in dirs:
+         if not os.path.islink(join(folder, name)):
+            os.utime(join(folder, name), (old, old))
+   return root
+
+
+def remove_tree(root):
+   os.chmod(root, 0o755)
+   for name in os.listdir(root):
+      path = join(root, name)
+      if os.path.isdir(path) and not os.path.islink(path):
+         os.chmod(path, 0o755)
+   shutil.rmtree(root)
+
+
+def walk_disk_usage(path):
+   """
+   The "os.walk" + "getsize" loop which was used before the scandir engine.
+   """
+   size = 0
+   errors = 0
+   for root, dirs, files in os.walk(path):
+      for name in files:
+         try:
+            size += getsize(join(root, name))
+         except OSError:
+            errors += 1
+   return size, errors
+
+
+def backend_mode(name):
+   def run(path):
+      backend = pydu.BACKENDS[name]()
+      try:
+         return pydu.disk_usage(path, backend=backend)
+      finally:
+         backend.close()
+   return run
+
+
+def parallel_mode(path):
+   return pydu.parallel_disk_usage([path], PARALLEL_JOBS)[0]
+
+
+def cached_mode(path):
+   """
+   Walk with the size cache. The harness runs this once before timing, so
+   the timed runs measure a fully populated cache.
+   """
+   cache = pydu.SizeCache(path + ".cache")
+   try:
+      return pydu.disk_usage(path, cache=cache)
+   finally:
+      cache.close()
+
+
+MODES = {
+   "os.walk": walk_disk_usage,
+   "parallel": parallel_mode,
+   "cached": cached_mode,
+}
+for _name in pydu.BACKENDS:
+   MODES[_name] = backend_mode(_name)
+
+
+def check_backends(root):
+   """
+   Make sure that all walker backends agree on <root>, for apparent and
+   allocated sizes, with and without hard-link detection and for the
+   per-folder sizes of the tree walk, and that they count the same as the
+   "os.walk" loop. Raises AssertionError otherwise.
+   """
+   reference = walk_disk_usage(root)
+   expected = None
+   for name in sorted(pydu.BACKENDS):
+      backend = pydu.BACKENDS[name]()
+      try:
+         results = []
+         for allocated in (False, True):
+            for inodes in (None, pydu.InodeSet()):
+               results.append(pydu.disk_usage(root, inodes=inodes,
+                     allocated=allocated, backend=backend))
+         folders = []
+         heaps = [[]]
+         results.append(pydu.tree_usage(root, heaps, 1, backend=backend,
+               visit=lambda *folder: folders.append(folder)))
+         results.append(folders)
+      finally:
+         backend.close()
+      assert results[0] == reference, "backend %r differs from os.walk: " \
+            "%r != %r" % (name, results[0], reference)
+      if expected is None:
+         expected = results
+      assert results == expected, "backend %r differs" % name
+
+
+def check(shapes, files):
+   """
+   Run "check_backends" on a new tree of each of the <shapes> with <files>
+   files. Returns the number of shapes which failed.
+   """
+   failures = 0
+   for shape in shapes:
+      root = make_tree(shape, files)
+      try:
+         check_backends(root)
+         print("%-10s ok" % shape)
+      except AssertionError as exc:
+         print("%-10s FAIL: %s" % (shape, exc))
+         failures += 1
+      finally:
+         remove_tree(root)
+   return failures
+
+
+def drop_caches():
+   """
+   Drop the page, dentry and inode caches. Returns False if not permitted.
+   """
+   try:
+      subprocess.call(["sync"])
+      with open("/proc/sys/vm/drop_caches", "w") as fptr:
+         fptr.write("3\n")
+      return True
+   except (IOError, OSError):
+      return False
+
+
+def run_mode(mode, path):
+   """
+   Executed in the child process: size <path> with <mode> and print the
+   elapsed time and the peak RSS as JSON.
+   """
+   import resource
+   start = time.time()
+   size, errors = MODES[mode](path)
+   elapsed = time.time() - start
+   maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   print(json.dumps({"elapsed": elapsed, "maxrss_kb": maxrss, "size": size,
+         "errors": errors}))
+
+
+def child(mode, path, cold=False):
+   """
+   Run <mode> on <path> in a fresh interpreter and return its measurements,
+   or None if the page cache could not be dropped for a <cold> run.
+   """
+   if cold and not drop_caches():
+      return None
+   output = subprocess.check_output([sys.executable, abspath(__file__),
+         "--run", mode, path])
+   return json.loads(output.decode("ascii"))
+
+
+def count_syscalls(mode, path):
+   """
+   Run one walk in a subprocess under "strace -c" and return the total
+   number of syscalls, or None if strace is not available.
+   """
+   fd, outfile = tempfile.mkstemp()
+   os.close(fd)
+   try:
+      cmd = ["strace", "-f", "-c", "-o", outfile, sys.executable,
+             abspath(__file__), "--run", mode, path]
+      try:
+         with open(os.devnull, "w") as devnull:
+            subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+      except OSError:
+         return None
+      for line in open(outfile):
+         fields = line.split()
+         if fields and fields[-1] == "total":
+            return int(fields[2])
+   finally:
+      os.unlink(outfile)
+   return None
+
+
+def bench(shape, modes, files, repeat):
+   """
+   Benchmark all <modes> on a new tree of <shape> and return a list with one
+   result dictionary per mode.
+   """
+   root = make_tree(shape, files)
+   try:
+      check_backends(root)
+      results = []
+      for mode in modes:
+         if mode == "cached":
+            child(mode, root)
+         cold = child(mode, root, cold=True)
+         runs = [child(mode, root) for _ in range(repeat)]
+         best = min(run["elapsed"] for run in runs)
+         results.append({
+            "shape": shape,
+            "mode": mode,
+            "files": files,
+            "files_per_s": files / max(best, 1e-9),
+            "warm_s": best,
+            "cold_s": cold and cold["elapsed"],
+            "syscalls": count_syscalls(mode, root),
+            "maxrss_kb": max(run["maxrss_kb"] for run in runs),
+         })
+      return results
+   finally:
+      remove_tree(root)
+      if os.path.exists(root + ".cache"):
+         os.unlink(root + ".cache")
+
+
+def revision():
+   try:
+      with open(os.devnull, "w") as devnull:
+         return subprocess.check_output(["git", "describe", "--always",
+               "--dirty"], cwd=dirname(abspath(__file__)),
+               stderr=devnull).decode("ascii").strip()
+   except (OSError, subprocess.CalledProcessError):
+      return None
+
+
+def print_results(results, baseline=None):
+   """
+   Print <results> as a table. If a <baseline> (an earlier JSON report) is
+   given, the change in files/s relative to it is shown as well.
+   """
+   previous = {}
+   for row in (baseline or {}).get("results", []):
+      previous[row["shape"], row["mode"]] = row
+
+   def fmt(value, template):
+      return "n/a" if value is None else template % value
+
+   print("%-11s %-9s %12s %9s %9s %12s %10s %8s" % ("shape", "mode",
+         "files/s", "warm [s]", "cold [s]", "syscalls", "RSS [kB]",
+         "change"))
+   for row in results:
+      old = previous.get((row["shape"], row["mode"]))
+      change = None
+      if old:
+         change = (row["files_per_s"] / old["files_per_s"] - 1) * 100
+      print("%-11s %-9s %12d %9.3f %9s %12s %10d %8s" % (row["shape"],
+            row["mode"], row["files_per_s"], row["warm_s"],
+            fmt(row["cold_s"], "%.3f"), fmt(row["syscalls"], "%d"),
+            row["maxrss_kb"], fmt(change, "%+.1f%%")))
+
+
+def linear_mountpoint(path, mounts):
+   """
+   The longest-prefix search done by "get_mountpoint" before the trie, with
+   the ordering bug (first instead of longest match) fixed.
+   """
+   path = abspath(path)
+   found = None
+   for mountpoint in mounts.keys():
+      if path.startswith(mountpoint) and (found is None
+            or len(mountpoint) > len(found["mountpoint"])):
+         found = mounts[mountpoint]
+   return found
+
+
+def make_mounts(count):
+   """
+   Return lines of a synthetic "/proc/mounts" similar to a container host
+   """
+   lines = ["/dev/sda1 / ext4 rw,relatime 0 0\n"]
+   for i in range(count - 1):
+      lines.append("overlay /var/lib/docker/overlay2/%08x/merged overlay "
+            "rw,relatime 0 0\n" % i)
+   return lines
+
+
+def bench_mounts(lookups=2000):
+   mounts = pydu.parse_mounts(make_mounts(MOUNT_COUNT))
+   paths = ["/var/lib/docker/overlay2/%08x/merged/etc" % (i * 7 % MOUNT_COUNT)
+         for i in range(lookups)]
+   start = time.time()
+   index = pydu.MountIndex(mounts)
+   build = time.time() - start
+
+   start = time.time()
+   for path in paths:
+      index.lookup(path)
+   trie = time.time() - start
+
+   start = time.time()
+   for path in paths[:lookups // 20]:
+      linear_mountpoint(path, mounts)
+   linear = (time.time() - start) * 20
+
+   print("%d mounts, %d lookups" % (MOUNT_COUNT, lookups))
+   print("%-10s %12s" % ("mode", "time [s]"))
+   print("%-10s %12.4f" % ("linear", linear))
+   print("%-10s %12.4f (+%.4f build)" % ("trie", trie, build))
+
+
+def main():
+   parser = OptionParser(usage="usage: %prog [options]")
+   parser.add_option("-n", "--files", dest="files", type="int",
+         help="Number of files per tree. Default: 100000, or %d with "
+         "--check" % CHECK_FILES)
+   parser.add_option("-s", "--shape", dest="shapes", action="append",
+         choices=sorted(SHAPES), type="choice", help="Tree shape to "
+         "benchmark. Can be repeated. Default: all of %s" % sorted(SHAPES))
+   parser.add_option("-m", "--mode", dest="modes", action="append",
+         choices=sorted(MODES), type="choice", help="Walker mode to "
+         "benchmark. Can be repeated. Default: all of %s" % sorted(MODES))
+   parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+         help="Number of warm runs per mode. The best one counts. Default: 3")
+   parser.add_option("-o", "--output", dest="output", metavar="FILE",
+         help="Save the results as JSON to FILE")
+   parser.add_option("-c", "--compare", dest="compare", metavar="FILE",
+         help="Compare with the results saved in FILE")
+   parser.add_option("--mounts", dest="mounts", action="store_true",
+         default=False, help="Also benchmark mount point lookups")
+   parser.add_option("--check", dest="check", action="store_true",
+         default=False, help="Only check that the walker backends agree "
+         "on every shape, nothing is timed")
+   options, args = parser.parse_args()
+
+   if options.check:
+      return check(options.shapes or sorted(SHAPES),
+            options.files or CHECK_FILES) and 1 or 0
+
+   results = []
+   for shape in options.shapes or sorted(SHAPES):
+      results.extend(bench(shape, options.modes or sorted(MODES),
+            options.files or 100000, options.repeat))
+
+   baseline = None
+   if options.compare:
+      with open(options.compare) as fptr:
+         baseline = json.load(fptr)
+   print_results(results, baseline)
+
+   if options.output:
+      with open(options.output, "w") as fptr:
+         json.dump({
+            "revision": revision(),
+            "python": platform.python_version(),
+            "time": time.time(),
+            "results": results,
+         }, fptr, indent=1)
+
+   if options.mounts:
+      print()
+      bench_mounts()
+   return 0
+
+
+if __name__ == "__main__":
+   if len(sys.argv) == 4 and sys.argv[1] == "--run":
+      run_mode(sys.argv[2], sys.argv[3])
+   else:
+      sys.exit(main())
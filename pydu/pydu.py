@@ -8,22 +8,54 @@ Based on the example shown in the python documentation of "os.walk"
 import re
 import os
 import sys
+import time
+import json
+import gzip
+import heapq
+import threading
+from array import array
+from collections import deque
 from os.path import (
     join,
-    getsize,
     isfile,
     islink,
     isdir,
     exists,
     abspath,
+    relpath,
     basename)
-from optparse import OptionParser
+from stat import S_ISDIR, S_ISLNK
+from optparse import OptionParser, SUPPRESS_HELP
+
+try:
+   from os import scandir
+except ImportError:
+   try:
+      from scandir import scandir
+   except ImportError:
+      scandir = None
+
+try:
+   import sqlite3
+except ImportError:
+   sqlite3 = None
 
 TERM = None
 # ignore "virtual" filesystems
 VIRTUAL_FS_TYPES = ["sysfs", "fusectl", "debugfs", "securityfs", "devtmpfs",
       "devpts", "tmpfs", "proc", "binfmt_misc", "fuse.gvfs-fuse-daemon",
       "fuse.truecrypt"]
+# maximum number of folders kept in the size cache
+MAX_CACHE_ENTRIES = 2000000
+# bump whenever the layout of the size cache changes
+CACHE_SCHEMA_VERSION = 2
+
+# typecodes for arrays of 64 bit integers ('q' and 'Q' need Python 3.3)
+try:
+   array('Q')
+   _U64, _I64 = 'Q', 'q'
+except ValueError:
+   _U64, _I64 = 'L', 'l'
 
 ## {{{ http://code.activestate.com/recipes/475116/ (r3)
 
@@ -174,9 +206,18 @@ class TerminalController:
 
 ## end of http://code.activestate.com/recipes/475116/ }}}
 
+class PlainTerminal(TerminalController):
+   """
+   A terminal without any capabilities. Used to format output without
+   escape codes, e.g. when pydu is used as a library.
+   """
+
+   def __init__(self):
+      pass
+
 def human_readable( size ):
    """
-   Return a human-readable disk-size (B, kB, MB, GB)
+   Return a human-readable disk-size (B, kB, MB, GB, TB)
    """
    if size < 1024:
       return "%d B" % size
@@ -186,91 +227,1184 @@ def human_readable( size ):
       return "%1.2f MB" % (size/1024.0**2)
    elif size < 1024**4:
       return "%1.2f GB" % (size/1024.0**3)
+   else:
+      return "%1.2f TB" % (size/1024.0**4)
 
-def disk_usage( path, ignored_dirs=[], verbose=False ):
+def _blocks_size( stat_result ):
+   """
+   Return the space allocated on disk for a file (which differs from the
+   apparent size for sparse and very small files).
+   """
+   blocks = getattr(stat_result, "st_blocks", None)
+   if blocks is None:
+      return stat_result.st_size
+   return blocks * 512
+
+class InodeSet(object):
+   """
+   A thread-safe set of "(st_dev, st_ino)" pairs, used to count hard-linked
+   files only once.
+
+   Each device gets a flat open-addressing hash table of unsigned 64 bit
+   integers. This costs about 16 bytes per inode, compared to well over 100
+   bytes for a Python set of tuples, and keeps tens of millions of inodes
+   manageable.
+   """
+
+   def __init__(self):
+      self._tables = {}
+      self._lock = threading.Lock()
+
+   def __len__(self):
+      return sum(count for _, count in self._tables.values())
+
+   def add(self, dev, ino):
+      """
+      Add an inode. Returns False if it was already in the set.
+      """
+      key = ino + 1 # 0 marks an empty slot
+      self._lock.acquire()
+      try:
+         table = self._tables.get(dev)
+         if table is None:
+            table = self._tables[dev] = [array(_U64, [0]) * 1024, 0]
+         if (table[1] + 1) * 3 > len(table[0]) * 2:
+            self._grow(table)
+         if not self._insert(table[0], key):
+            return False
+         table[1] += 1
+         return True
+      finally:
+         self._lock.release()
+
+   @staticmethod
+   def _insert(slots, key):
+      mask = len(slots) - 1
+      # Fibonacci hashing spreads sequential inode numbers over the table
+      shift = 64 - mask.bit_length()
+      index = ((key * 11400714819323198485) & 0xFFFFFFFFFFFFFFFF) >> shift
+      while True:
+         current = slots[index]
+         if current == 0:
+            slots[index] = key
+            return True
+         if current == key:
+            return False
+         index = (index + 1) & mask
+
+   def _grow(self, table):
+      old = table[0]
+      slots = array(_U64, [0]) * (len(old) * 2)
+      for key in old:
+         if key:
+            self._insert(slots, key)
+      table[0] = slots
+
+def _mtime_ns( stat_result ):
+   mtime_ns = getattr(stat_result, "st_mtime_ns", None)
+   if mtime_ns is None:
+      mtime_ns = int(stat_result.st_mtime * 1000000000)
+   return mtime_ns
+
+class SizeCache(object):
+   """
+   Persistent per-folder sizes (apparent and allocated), stored in an SQLite
+   database.
+
+   A folder is identified by "(st_dev, st_ino)" and its entry stays valid as
+   long as the folder's "st_mtime_ns" does not change. Only the size of the
+   files *directly* inside the folder and the names of its sub-folders are
+   stored: a change deep down in a tree does not touch the mtime of its
+   parents, so each sub-folder is still checked on its own. A cache hit
+   saves listing the folder and stat'ing its files.
+
+   Files which are modified in place do not change the mtime of their folder
+   either. Such changes are only noticed after rebuilding the cache. Folders
+   containing hard-linked files are never cached because their size depends
+   on which links have already been counted.
+
+   The least recently used entries are dropped once the cache holds more
+   than <max_entries> folders.
+   """
+
+   def __init__(self, filename=None, max_entries=MAX_CACHE_ENTRIES,
+         rebuild=False):
+      if filename is None:
+         cache_home = os.environ.get("XDG_CACHE_HOME",
+               join(os.path.expanduser("~"), ".cache"))
+         filename = join(cache_home, "pydu", "sizes.sqlite")
+      if not exists(os.path.dirname(filename)):
+         os.makedirs(os.path.dirname(filename))
+      self.max_entries = max_entries
+      self._lock = threading.Lock()
+      # folders modified after this point may change again within the
+      # resolution of their timestamp. They are not cached.
+      self._recent = int((time.time() - 2) * 1000000000)
+      self._conn = sqlite3.connect(filename, check_same_thread=False)
+      self._conn.text_factory = str
+      version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+      if version != CACHE_SCHEMA_VERSION:
+         self._conn.execute("DROP TABLE IF EXISTS folders")
+         self._conn.execute("PRAGMA user_version = %d" % CACHE_SCHEMA_VERSION)
+      self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS folders ("
+            "dev INTEGER, ino INTEGER, mtime INTEGER, size INTEGER, "
+            "blocks INTEGER, subdirs TEXT, used INTEGER, "
+            "PRIMARY KEY (dev, ino))")
+      if rebuild:
+         self._conn.execute("DELETE FROM folders")
+      self._run = self._conn.execute(
+            "SELECT COALESCE(MAX(used), 0) + 1 FROM folders").fetchone()[0]
+
+   def get(self, stat_result):
+      """
+      Return a tuple (size, blocks_size, subdir_names) for the folder
+      described by <stat_result> or None if it is unknown or has changed since.
+      """
+      key = (stat_result.st_dev, stat_result.st_ino)
+      self._lock.acquire()
+      try:
+         row = self._conn.execute(
+               "SELECT mtime, size, blocks, subdirs FROM folders "
+               "WHERE dev=? AND ino=?", key).fetchone()
+         if row is None or row[0] != _mtime_ns(stat_result):
+            return None
+         self._conn.execute("UPDATE folders SET used=? WHERE dev=? AND ino=?",
+               (self._run,) + key)
+      finally:
+         self._lock.release()
+      return row[1], row[2], row[3] and row[3].split("/") or []
+
+   def put(self, stat_result, size, blocks_size, subdir_names):
+      mtime = _mtime_ns(stat_result)
+      if mtime >= self._recent:
+         return
+      self._lock.acquire()
+      try:
+         self._conn.execute("INSERT OR REPLACE INTO folders "
+               "VALUES (?, ?, ?, ?, ?, ?, ?)", (stat_result.st_dev,
+               stat_result.st_ino, mtime, size, blocks_size,
+               "/".join(subdir_names), self._run))
+      except UnicodeError:
+         # undecodable file names are simply not cached.
+         pass
+      finally:
+         self._lock.release()
+
+   def close(self):
+      """
+      Evict the least recently used folders and write the cache to disk.
+      """
+      self._lock.acquire()
+      try:
+         count = self._conn.execute("SELECT COUNT(*) FROM folders").fetchone()[0]
+         if count > self.max_entries:
+            self._conn.execute("DELETE FROM folders WHERE rowid IN ("
+                  "SELECT rowid FROM folders ORDER BY used LIMIT ?)",
+                  (count - self.max_entries,))
+         self._conn.commit()
+         self._conn.close()
+      finally:
+         self._lock.release()
+
+def open_cache( options ):
+   """
+   Return the SizeCache requested by the command-line <options>, or None
+   if caching is disabled (the default) or not available.
+
+   The cache is never used for snapshots (--export): they exist to show
+   what grew, and files growing in place are exactly what it misses.
+   """
+   if not (options.cache or options.rebuild_cache):
+      return None
+   if options.export:
+      if not options.quiet:
+         sys.stderr.write( "The size cache is not used with --export.\n" )
+      return None
+   if sqlite3 is None:
+      if options.verbose:
+         sys.stderr.write( "sqlite3 is not available. Cache disabled.\n" )
+      return None
+   try:
+      return SizeCache(rebuild=options.rebuild_cache)
+   except (OSError, sqlite3.Error), e:
+      sys.stderr.write( "Unable to open the size cache (%s)\n" % e )
+      return None
+
+def disk_usage( path, ignored_dirs=[], verbose=False, cache=None,
+      inodes=None, allocated=False, progress=None, backend=None ):
+   """
+   Return a tuple (size, errors) for <path>.
+
+   If an InodeSet is passed as <inodes>, files with several hard links are
+   only counted the first time one of their links is seen. With <allocated>
+   the space allocated on disk is reported instead of the apparent size.
+   Each scanned folder is reported to <progress> (see "Progress") and
+   listed by <backend> (see BACKENDS).
+   """
    size = 0
    errors = 0
    path = abspath(path)
 
    if isfile( path ):
       try:
-         return getsize( path ), 0
+         file_stat = os.stat( path )
+         if inodes is not None and file_stat.st_nlink > 1 and \
+               not inodes.add( file_stat.st_dev, file_stat.st_ino ):
+            return 0, 0
+         if allocated:
+            return _blocks_size( file_stat ), 0
+         return file_stat.st_size, 0
       except OSError, e:
          errors += 1
          if verbose:
             sys.stderr.write( "Unable to determine size for %r (%s)\n" % (
-               join(root, name), str(e)) )
+               path, str(e)) )
          return 0, errors
 
-   for root, dirs, files in os.walk( path ):
-      for name in files:
+   # Explicit stack instead of recursion: deep trees would otherwise hit the
+   # interpreter's recursion limit.
+   pending = [path]
+   while pending:
+      dir_size, dir_errors, subdirs = _scan_dir( pending.pop(), ignored_dirs,
+            verbose, cache, inodes, allocated, progress, backend )
+      size += dir_size
+      errors += dir_errors
+      pending.extend(subdirs)
+
+   return size, errors
+
+class _ListdirEntry(object):
+   """
+   Minimal stand-in for "os.DirEntry" on interpreters without "scandir".
+   """
+   __slots__ = ("name", "path", "_stat")
+
+   def __init__(self, root, name):
+      self.name = name
+      self.path = join(root, name)
+      self._stat = None
+
+   def stat(self, follow_symlinks=True):
+      if self._stat is None:
+         self._stat = os.lstat(self.path)
+      if follow_symlinks and S_ISLNK(self._stat.st_mode):
+         return os.stat(self.path)
+      return self._stat
+
+   def is_symlink(self):
+      return S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+   def is_dir(self, follow_symlinks=True):
+      try:
+         return S_ISDIR(self.stat(follow_symlinks).st_mode)
+      except OSError:
+         return False  # a broken link, like os.DirEntry
+
+def _file_stat( entry ):
+   """
+   Return the stat result to count for the directory entry <entry>, which
+   is not a folder, or None if it is not counted. Like "getsize", symlinks
+   to files count with the size of their target. Symlinks to folders are
+   neither followed nor counted, like "os.walk" does. Raises OSError for
+   broken symlinks.
+   """
+   if not entry.is_symlink():
+      return entry.stat(follow_symlinks=False)
+   if entry.is_dir():
+      return None
+   return entry.stat()
+
+def _iter_dir( path ):
+   if scandir is not None:
+      return scandir( path )
+   return (_ListdirEntry(path, name) for name in os.listdir( path ))
+
+class DirListing(object):
+   """
+   The contents of one folder, as returned by the walker backends.
+
+   File sizes are collected in flat arrays instead of one Python object per
+   file. Files with more than one hard link are kept apart, together with
+   their device and inode numbers, so they can be counted only once.
+   """
+   __slots__ = ("subdirs", "sizes", "blocks", "link_devs", "link_inos",
+         "link_sizes", "link_blocks", "errors")
+
+   def __init__(self):
+      self.subdirs = []    #: names of the sub-folders
+      self.sizes = array(_I64)
+      self.blocks = array(_I64)
+      self.link_devs = array(_U64)
+      self.link_inos = array(_U64)
+      self.link_sizes = array(_I64)
+      self.link_blocks = array(_I64)
+      self.errors = []     #: (path, exception) tuples
+
+   def __len__(self):
+      return len(self.sizes) + len(self.link_sizes)
+
+   def add(self, stat_result):
+      if stat_result.st_nlink > 1:
+         self.link_devs.append(stat_result.st_dev)
+         self.link_inos.append(stat_result.st_ino)
+         self.link_sizes.append(stat_result.st_size)
+         self.link_blocks.append(_blocks_size( stat_result ))
+      else:
+         self.sizes.append(stat_result.st_size)
+         self.blocks.append(_blocks_size( stat_result ))
+
+   def extend(self, other):
+      for name in self.__slots__:
+         getattr(self, name).extend(getattr(other, name))
+
+class ScandirBackend(object):
+   """
+   Walker backend listing folders with "scandir". The file type comes with
+   the listing, so only files are stat'ed, one after the other. Symlinks
+   are counted as described in "_file_stat".
+   """
+
+   def list_dir(self, path):
+      """
+      Return a DirListing for <path>. Raises OSError if the folder cannot
+      be read.
+      """
+      listing = DirListing()
+      for entry in _iter_dir( path ):
+         try:
+            if entry.is_dir(follow_symlinks=False):
+               listing.subdirs.append(entry.name)
+               continue
+            stat_result = _file_stat( entry )
+            if stat_result is not None:
+               listing.add(stat_result)
+         except OSError, e:
+            listing.errors.append((entry.path, e))
+      return listing
+
+   def close(self):
+      pass
+
+class BatchStatBackend(object):
+   """
+   Walker backend listing folders with "os.listdir" and stat'ing the entries
+   of large folders in batches on a pool of <threads> threads.
+
+   "lstat" releases the GIL, so on high-latency storage (NFS, cold disks)
+   many stat calls of one folder are in flight at the same time. This pays
+   off for folders with thousands of small files. The pool is shared by all
+   walker threads. Symlinks are counted like by "ScandirBackend".
+   """
+
+   def __init__(self, threads=8, batch_size=256):
+      self.threads = threads
+      self.batch_size = batch_size
+      self._pool = None
+      self._lock = threading.Lock()
+
+   @staticmethod
+   def _stat_batch(args):
+      path, names = args
+      listing = DirListing()
+      lstat = os.lstat
+      for name in names:
+         fullname = join(path, name)
+         try:
+            stat_result = lstat(fullname)
+            if S_ISLNK(stat_result.st_mode):
+               stat_result = os.stat(fullname)
+               if S_ISDIR(stat_result.st_mode):
+                  continue
+            elif S_ISDIR(stat_result.st_mode):
+               listing.subdirs.append(name)
+               continue
+         except OSError, e:
+            listing.errors.append((fullname, e))
+            continue
+         listing.add(stat_result)
+      return listing
+
+   def list_dir(self, path):
+      names = os.listdir( path )
+      if len(names) <= self.batch_size:
+         return self._stat_batch((path, names))
+
+      self._lock.acquire()
+      try:
+         if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.threads)
+      finally:
+         self._lock.release()
+      listing = DirListing()
+      batches = [(path, names[i:i + self.batch_size])
+            for i in range(0, len(names), self.batch_size)]
+      for part in self._pool.imap(self._stat_batch, batches):
+         listing.extend(part)
+      return listing
+
+   def close(self):
+      if self._pool is not None:
+         self._pool.close()
+         self._pool.join()
+         self._pool = None
+
+BACKENDS = {
+   "scandir": ScandirBackend,
+   "batch": BatchStatBackend,
+}
+DEFAULT_BACKEND = ScandirBackend()
+
+def _scan_dir( path, ignored_dirs=[], verbose=False, cache=None, inodes=None,
+      allocated=False, progress=None, backend=None ):
+   """
+   Determine the size of the files directly contained in <path>.
+
+   Returns a tuple (size, errors, subdirs) where "subdirs" lists the folders
+   which still need to be visited.
+
+   The folder is listed by <backend> (see BACKENDS, "scandir" by default).
+   Symlinks to files count with the size of their target, broken symlinks
+   as errors, and symlinks to folders are skipped, like with "os.walk" and
+   "getsize". If a <cache> is given, unchanged folders are not listed at
+   all. See "disk_usage" for <inodes> and <allocated>.
+   """
+   folder_stat = None
+   if cache is not None:
+      try:
+         folder_stat = os.stat( path )
+      except OSError:
+         return 0, 0, []
+      cached = cache.get( folder_stat )
+      if cached is not None:
+         size, blocks_size, names = cached
+         if allocated:
+            size = blocks_size
+         if progress is not None:
+            progress.update( path, 0, size )
+         return size, 0, [join(path, name) for name in names
+               if name not in ignored_dirs]
+
+   try:
+      listing = (backend or DEFAULT_BACKEND).list_dir( path )
+   except OSError:
+      # os.walk silently skips folders it cannot read. So do we.
+      return 0, 0, []
+
+   if verbose:
+      for entry_path, e in listing.errors:
+         sys.stderr.write( "Unable to determine size for %r (%s)\n" % (
+            entry_path, str(e)) )
+   errors = len(listing.errors)
+   size = sum(listing.sizes)
+   blocks_size = sum(listing.blocks)
+   for i in range(len(listing.link_inos)):
+      if inodes is None or inodes.add( listing.link_devs[i],
+            listing.link_inos[i] ):
+         size += listing.link_sizes[i]
+         blocks_size += listing.link_blocks[i]
+
+   # folders with errors are rescanned, so verbose runs report them again.
+   # Folders with hard links depend on the links seen before.
+   if folder_stat is not None and not errors and not listing.link_inos:
+      cache.put( folder_stat, size, blocks_size, listing.subdirs )
+   if allocated:
+      size = blocks_size
+   if progress is not None:
+      progress.update( path, len(listing), size )
+   return size, errors, [join(path, name) for name in listing.subdirs
+         if name not in ignored_dirs]
+
+def tree_usage( path, heaps, top, ignored_dirs=[], verbose=False, cache=None,
+      inodes=None, allocated=False, progress=None, visit=None, backend=None ):
+   """
+   Like "disk_usage" for a folder, but also collects the size of each
+   sub-folder during the same walk. Returns a tuple (size, errors).
+
+   <heaps> contains one heap per level: "heaps[0]" receives <path> itself,
+   "heaps[1]" its sub-folders and so on. Each heap keeps only the <top>
+   largest (size, path, errors) tuples, so memory does not grow with the
+   size of the tree. Deeper folders are only added to their parents.
+
+   If given, <visit> is called with (path, size, errors) for every folder
+   once it is complete. Sub-folders are then visited in sorted order, so the
+   calls follow the order of "snapshot_key".
+   """
+   def scan( folder ):
+      frame = [folder] + list(_scan_dir( folder, ignored_dirs, verbose,
+            cache, inodes, allocated, progress, backend ))
+      if visit is not None:
+         # folders are taken from the end of the list
+         frame[3].sort(reverse=True)
+      return frame
+
+   path = abspath(path)
+   # Each frame holds [path, size, errors, sub-folders not yet visited]. A
+   # frame is complete once all its sub-folders have been added to it.
+   stack = [scan( path )]
+   while True:
+      frame = stack[-1]
+      if frame[3]:
+         stack.append(scan( frame[3].pop() ))
+         continue
+
+      stack.pop()
+      if visit is not None:
+         visit(frame[0], frame[1], frame[2])
+      level = len(stack)
+      if level < len(heaps):
+         item = (frame[1], frame[0], frame[2])
+         if len(heaps[level]) < top:
+            heapq.heappush(heaps[level], item)
+         else:
+            heapq.heappushpop(heaps[level], item)
+      if not stack:
+         return frame[1], frame[2]
+      stack[-1][1] += frame[1]
+      stack[-1][2] += frame[2]
+
+def parallel_disk_usage( paths, jobs, ignored_dirs=[], verbose=False,
+      cache=None, inodes=None, allocated=False, progress=None, done=None,
+      backend=None ):
+   """
+   Same as calling "disk_usage" on each element of <paths>, but the work is
+   spread over <jobs> threads. Returns a list of (size, errors) tuples in the
+   same order as <paths>.
+
+   When hard links are counted once (see <inodes>), a file linked from two
+   entries is credited to whichever entry reaches it first. The total is the
+   same as in the serial path, the split between entries may differ.
+
+   Each folder is a separate task, so one huge entry keeps all workers busy.
+   Every worker owns a deque of pending folders. It takes work from the tail
+   of its own deque and, once that runs dry, steals from the head of the
+   other deques (which holds the oldest, usually biggest subtrees).
+
+   If given, <done> is called with (index, size, errors) as soon as the
+   element <index> of <paths> is completely sized.
+   """
+   paths = [abspath(p) for p in paths]
+   results = [[0, 0] for _ in paths]
+   # number of unfinished folders per element of <paths>
+   outstanding = [0 for _ in paths]
+   queues = [deque() for _ in range(jobs)]
+   lock = threading.Condition()
+   state = {"pending": 0}
+   failures = []
+
+   for index, path in enumerate(paths):
+      if isfile( path ):
+         results[index] = list(disk_usage( path, ignored_dirs, verbose,
+               cache, inodes, allocated, progress, backend ))
+         if done is not None:
+            done(index, results[index][0], results[index][1])
+         continue
+      queues[index % jobs].append((index, path))
+      outstanding[index] = 1
+      state["pending"] += 1
+
+   def steal( me ):
+      for offset in range(1, jobs):
+         try:
+            return queues[(me + offset) % jobs].popleft()
+         except IndexError:
+            pass
+      return None
+
+   def worker( me ):
+      own = queues[me]
+      while True:
+         try:
+            task = own.pop()
+         except IndexError:
+            task = steal( me )
+         if task is None:
+            lock.acquire()
+            try:
+               if state["pending"] == 0:
+                  return
+               lock.wait(0.05)
+            finally:
+               lock.release()
+            continue
+
+         index, path = task
+         size = errors = 0
+         subdirs = []
+         try:
+            size, errors, subdirs = _scan_dir( path, ignored_dirs, verbose,
+                  cache, inodes, allocated, progress, backend )
+         except Exception, e:
+            failures.append(e)
+         lock.acquire()
+         try:
+            results[index][0] += size
+            results[index][1] += errors
+            # the new tasks have to be counted before they become visible
+            # to the other workers.
+            own.extend((index, subdir) for subdir in subdirs)
+            outstanding[index] += len(subdirs) - 1
+            finished = outstanding[index] == 0
+            state["pending"] += len(subdirs) - 1
+            if subdirs or state["pending"] == 0:
+               lock.notify_all()
+         finally:
+            lock.release()
+         if finished and done is not None:
+            done(index, results[index][0], results[index][1])
+
+   threads = [threading.Thread(target=worker, args=(i,))
+         for i in range(jobs)]
+   for thread in threads:
+      thread.daemon = True
+      thread.start()
+   for thread in threads:
+      thread.join()
+   if failures:
+      raise failures[0]
+   return [tuple(x) for x in results]
+
+class SizeTree(object):
+   """
+   Lazily evaluated disk usage of a file or folder, for embedding pydu in
+   other programs:
+
+      >>> tree = SizeTree("/srv", allocated=True)
+      >>> tree.size
+      >>> for child in tree.largest(5):
+      ...     print child.path, child.size, child.errors
+
+   The entries of a folder are only listed when "children" is first
+   accessed and sizes are only computed when "size" or "errors" is first
+   accessed. Both are memoized, so keep a tree around as long as its numbers
+   are current enough and create a new one to rescan. Nothing is printed and
+   no global state is used: trees can be created and read from any number of
+   threads, and the nodes of one tree may be shared between threads.
+
+   All nodes of a tree share the settings of the root: <ignored_dirs>,
+   <allocated> and <verbose> as for "disk_usage", an optional SizeCache as
+   <cache> (shared with other trees), a walker <backend> (see BACKENDS) and
+   a Progress display as <progress>. A folder whose children were listed is
+   summed up from them instead of being walked again.
+
+   Hard-linked files are counted once per tree unless <count_links> is set:
+   like with "du", a file linked from several folders is credited to the
+   node which is measured first. Totals do not depend on that order.
+
+   Only the entries of <path> itself can be filtered: <select> is called
+   with the path of each of them and those for which it returns false are
+   left out of "children" and of the size of the tree. Symlinks are counted
+   as described in "_scan_dir". With <follow_symlinks>, symlinks to folders
+   among the entries of <path> are sized like folders.
+   """
+   __slots__ = ("path", "is_dir", "_settings", "_select", "_follow_symlinks",
+         "_children", "_usage", "_lock")
+
+   def __init__(self, path, ignored_dirs=(), allocated=False,
+         count_links=False, verbose=False, cache=None, backend=None,
+         progress=None, select=None, follow_symlinks=False):
+      self.path = abspath(path)
+      self.is_dir = isdir(self.path)
+      inodes = None
+      if not count_links:
+         inodes = InodeSet()
+      self._settings = (tuple(ignored_dirs), allocated, inodes, verbose,
+            cache, backend, progress)
+      self._select = select
+      self._follow_symlinks = follow_symlinks
+      self._children = None
+      self._usage = None  # (size, errors) once measured
+      self._lock = threading.RLock()
+
+   @classmethod
+   def _child(cls, parent, path, is_dir):
+      node = cls.__new__(cls)
+      node.path = path
+      node.is_dir = is_dir
+      node._settings = parent._settings
+      node._select = None
+      node._follow_symlinks = False
+      node._children = None
+      node._usage = None
+      node._lock = threading.RLock()
+      return node
+
+   def __repr__(self):
+      return "<SizeTree %r>" % self.path
+
+   def __iter__(self):
+      return iter(self.children)
+
+   @property
+   def name(self):
+      return basename(self.path)
+
+   @property
+   def children(self):
+      """
+      The files and folders contained in this folder, as SizeTree nodes,
+      sorted by path. Files have no children.
+      """
+      self._lock.acquire()
+      try:
+         if self._children is None:
+            self._children = self._list()
+         return self._children
+      finally:
+         self._lock.release()
+
+   @property
+   def size(self):
+      return self._measure()[0]
+
+   @property
+   def errors(self):
+      return self._measure()[1]
+
+   def largest(self, count):
+      """
+      Return the <count> largest children, largest first
+      """
+      return heapq.nlargest(count, self.children, key=lambda x: x.size)
+
+   def measure_children(self, jobs=1, done=None):
+      """
+      Compute the sizes of all children on <jobs> threads at once (see
+      "parallel_disk_usage") and return the children. If given, <done> is
+      called with each child as soon as it is sized.
+      """
+      children = self.children
+      # folders not listed yet are walked as a whole
+      pending = [x for x in children if x._children is None]
+      if jobs > 1 and len(pending) > 1:
+         # children are locked in the order "_measure" uses
+         for child in pending:
+            child._lock.acquire()
          try:
-            size += getsize(join(root, name))
+            walked = [x for x in pending if x._usage is None]
+            self._walk( walked, jobs, done )
+         finally:
+            for child in pending:
+               child._lock.release()
+      else:
+         walked = []
+      walked = set(id(x) for x in walked)
+      for child in children:
+         if id(child) not in walked:
+            child._measure()
+            if done is not None:
+               done( child )
+      return children
+
+   def _walk(self, nodes, jobs, done):
+      ignored_dirs, allocated, inodes, verbose, cache, backend, progress = \
+            self._settings
+
+      def finished( index, size, errors ):
+         nodes[index]._usage = (size, errors)
+         if done is not None:
+            done( nodes[index] )
+
+      parallel_disk_usage( [x.path for x in nodes], jobs, ignored_dirs,
+            verbose, cache, inodes, allocated, progress, finished, backend )
+
+   def _list(self):
+      ignored_dirs, allocated, inodes, verbose = self._settings[:4]
+      if not self.is_dir:
+         return []
+      try:
+         entries = list(_iter_dir( self.path ))
+      except OSError:
+         # unreadable folders are skipped, as by "disk_usage"
+         return []
+
+      children = []
+      for entry in entries:
+         if self._select is not None and not self._select( entry.path ):
+            continue
+         try:
+            is_dir = entry.is_dir(follow_symlinks=False) or (
+                  self._follow_symlinks and entry.is_dir())
+            if is_dir and entry.name in ignored_dirs:
+               continue
+            child = SizeTree._child(self, entry.path, is_dir)
+            if not is_dir:
+               # sized right away, the stat comes (almost) for free
+               entry_stat = _file_stat( entry )
+               if entry_stat is None:
+                  continue
+               size = 0
+               if inodes is None or entry_stat.st_nlink <= 1 or \
+                     inodes.add( entry_stat.st_dev, entry_stat.st_ino ):
+                  size = entry_stat.st_size
+                  if allocated:
+                     size = _blocks_size( entry_stat )
+               child._usage = (size, 0)
          except OSError, e:
+            child = SizeTree._child(self, entry.path, False)
+            child._usage = (0, 1)
             if verbose:
                sys.stderr.write( "Unable to determine size for %r (%s)\n" % (
-                  join(root, name), str(e)) )
-            errors += 1
-
-      for idir in ignored_dirs:
-         if idir in dirs:
-            dirs.remove(idir) # ignore this folder
+                  entry.path, str(e)) )
+         children.append(child)
+      children.sort(key=lambda x: x.path)
+      return children
 
-   return size, errors
+   def _measure(self):
+      # set once, in one assignment: no need to wait for the lock, which
+      # "measure_children" holds while the walker threads report sizes
+      usage = self._usage
+      if usage is not None:
+         return usage
+      self._lock.acquire()
+      try:
+         if self._usage is None:
+            if self._select is not None:
+               # only the selected entries count
+               self.children
+            if self._children is not None:
+               size = errors = 0
+               for child in self._children:
+                  child_size, child_errors = child._measure()
+                  size += child_size
+                  errors += child_errors
+            else:
+               (ignored_dirs, allocated, inodes, verbose, cache, backend,
+                     progress) = self._settings
+               size, errors = disk_usage( self.path, ignored_dirs, verbose,
+                     cache, inodes, allocated, progress, backend )
+            self._usage = (size, errors)
+         return self._usage
+      finally:
+         self._lock.release()
 
-def get_first_level_sizes( path, options ):
+def _entry_filter( path, options, term ):
    """
-   Determine the size for each folder and file in <path>
+   Return a function telling whether an entry of <path> should be reported,
+   honouring the command-line <options>. Skipped entries are announced on
+   <term> unless <options.quiet> is set.
    """
    path = abspath( path )
-   mounts = get_mounts()
-   root_mp = get_mountpoint( path, mounts )
+   mounts = MountIndex( get_mounts() )
+   root_mp = mounts.lookup( path )
+   root_dev = os.stat( path ).st_dev
 
-   if not options.quiet:
-      print TERM.YELLOW + "Calculating ..." + TERM.NORMAL
-   output = []
-   for entry in os.listdir(path):
-      entry_path = join(path,entry)
-      entry_mp   = get_mountpoint( entry_path, mounts )
+   def skip( message, entry_path ):
+      if not options.quiet:
+         print "%s%s %r%s" % (term.YELLOW, message, entry_path, term.NORMAL)
+      return False
+
+   def select( entry_path ):
+      try:
+         entry_dev = os.lstat( entry_path ).st_dev
+      except OSError:
+         entry_dev = root_dev
+
+      # Only entries on another device can be a different mount. Everything
+      # else shares the mount information of <path>.
+      if entry_dev == root_dev:
+         entry_mp = root_mp
+      else:
+         entry_mp = mounts.lookup( entry_path )
 
       # ignore files on different mountpoints (if enabled)
-      if entry_mp['mountpoint'] != root_mp['mountpoint'] and options.one_fs:
-         if not options.quiet:
-            print "%sIgnoring different FS %r%s" % (TERM.YELLOW, entry_path,
-                  TERM.NORMAL)
-         continue
+      if entry_dev != root_dev and options.one_fs:
+         return skip( "Ignoring different FS", entry_path )
 
       # ignore symbolic links unless forced
       if islink(entry_path) and not options.follow_symlinks:
-         if not options.quiet:
-            print "%sIgnoring symlink %r%s" % (TERM.YELLOW, entry_path,
-                  TERM.NORMAL)
-         continue
+         return skip( "Ignoring symlink", entry_path )
 
       # ignore "virtual" filesystems
       if entry_mp['type'] in VIRTUAL_FS_TYPES and not options.include_virtual:
-         if not options.quiet:
-            print "%sIgnoring virtual FS on %r%s" % (TERM.YELLOW, entry_path,
-                  TERM.NORMAL)
-         continue
+         return skip( "Ignoring virtual FS on", entry_path )
+      return True
 
-      du, errors = disk_usage( join(path, entry), verbose=options.verbose )
-      output.append((
-         entry_path,
-         du,
-         errors
-         ))
+   return select
+
+def _first_level_entries( path, options, term ):
+   """
+   Return the entries of <path> which should be reported, honouring the
+   command-line <options> (see "_entry_filter").
+   """
+   path = abspath( path )
+   select = _entry_filter( path, options, term )
+   if not options.quiet:
+      print term.YELLOW + "Calculating ..." + term.NORMAL
+   return [join(path, entry) for entry in os.listdir(path)
+         if select( join(path, entry) )]
+
+def get_first_level_sizes( path, options, term=None ):
+   """
+   Determine the size for each folder and file in <path>, honouring the
+   command-line <options>. Returns a list of (path, size, errors) tuples.
+   Messages and the progress display go to <term>, plain text by default.
+   """
+   term = term or PlainTerminal()
+   select = _entry_filter( path, options, term )
+   if not options.quiet:
+      print term.YELLOW + "Calculating ..." + term.NORMAL
+   cache = open_cache( options )
+   progress = open_progress( options, term )
+   backend = BACKENDS[options.backend]()
+   tree = SizeTree( path, allocated=options.allocated,
+         count_links=options.count_links, verbose=options.verbose,
+         cache=cache, backend=backend, progress=progress, select=select,
+         follow_symlinks=options.follow_symlinks )
+
+   def done( child ):
+      if progress is not None:
+         progress.entry_done( child.path, child.size, child.errors )
+
+   try:
+      children = tree.measure_children( options.jobs, done )
+   finally:
+      backend.close()
+      if progress is not None:
+         progress.close()
+      if cache is not None:
+         cache.close()
+
+   return [(child.path, child.size, child.errors) for child in children]
+
+def get_tree_sizes( path, options, term=None ):
+   """
+   Determine the size of every folder up to <options.depth> levels below
+   <path> in a single walk, keeping the <options.top> largest folders of each
+   level. If <options.export> is set, the size of every folder is also
+   written to that snapshot file (see "write_snapshot").
+
+   Returns a list of (level, results) tuples, where "results" has the same
+   layout as the output of "get_first_level_sizes". Without <options.depth>
+   the only level is the complete list of entries of <path>. Folders are
+   walked one after the other ("--jobs" is not used). Messages go to <term>
+   as in "get_first_level_sizes".
+   """
+   path = abspath( path )
+   term = term or PlainTerminal()
+   entries = sorted(_first_level_entries( path, options, term ))
+   cache = open_cache( options )
+   progress = open_progress( options, term )
+   backend = BACKENDS[options.backend]()
+   inodes = None
+   if not options.count_links:
+      inodes = InodeSet()
+   heaps = [[] for _ in range(options.depth)]
+   snapshot = None
+   visit = None
+   if options.export:
+      snapshot = open_snapshot( options.export, "w" )
+      write_snapshot_header( snapshot, path, options.allocated )
+      visit = lambda folder, size, errors: write_snapshot( snapshot,
+            folder[len(path) + 1:], size, errors )
+
+   first_level = []
+   try:
+      for entry_path in entries:
+         if isdir( entry_path ):
+            size, errors = tree_usage( entry_path, heaps, options.top,
+                  verbose=options.verbose, cache=cache, inodes=inodes,
+                  allocated=options.allocated, progress=progress,
+                  visit=visit, backend=backend )
+         else:
+            size, errors = disk_usage( entry_path, verbose=options.verbose,
+                  inodes=inodes, allocated=options.allocated )
+         first_level.append((entry_path, size, errors))
+         if progress is not None:
+            progress.entry_done( entry_path, size, errors )
+      if snapshot is not None:
+         write_snapshot( snapshot, "", sum(x[1] for x in first_level),
+               sum(x[2] for x in first_level) )
+   finally:
+      backend.close()
+      if snapshot is not None:
+         snapshot.close()
+      if progress is not None:
+         progress.close()
+      if cache is not None:
+         cache.close()
+
+   if not options.depth:
+      return [(1, first_level)]
+   output = []
+   for level, heap in enumerate(heaps):
+      output.append((level + 1, [(entry_path, size, errors)
+            for size, entry_path, errors in sorted(heap, reverse=True)]))
    return output
 
-def pretty_print( results ):
+def open_snapshot( filename, mode="r" ):
+   """
+   Open a snapshot file. Names ending in ".gz" are (de)compressed on the fly.
+   """
+   if filename.endswith(".gz"):
+      return gzip.open( filename, mode + "b" )
+   return open( filename, mode + "b" )
+
+def _to_text( path ):
+   if isinstance(path, bytes):
+      return path.decode("utf-8", "replace")
+   return path
+
+def write_snapshot_header( snapshot, root, allocated ):
+   """
+   A snapshot is a file with one JSON document per line (NDJSON). The first
+   line is an object describing the scan, all others are arrays of
+   [path, size, errors] for a folder. Paths are relative to the scanned
+   folder, which itself is stored as "". The folders are ordered by
+   "snapshot_key", so two snapshots can be compared in a single pass.
+   """
+   snapshot.write((json.dumps({"root": _to_text(root), "time": time.time(),
+         "allocated": allocated}) + "\n").encode("ascii"))
+
+def write_snapshot( snapshot, path, size, errors ):
+   snapshot.write((json.dumps([_to_text(path), size, errors],
+         separators=(",", ":")) + "\n").encode("ascii"))
+
+def read_snapshot_header( snapshot ):
+   """
+   Return the description of the scan at the start of a snapshot, see
+   "write_snapshot_header"
+   """
+   return json.loads(snapshot.readline().decode("ascii"))
+
+def read_snapshot( snapshot, header=True ):
+   """
+   Yield the (path, size, errors) tuples of a snapshot, one line at a time.
+   Pass <header>=False if the header was already read with
+   "read_snapshot_header".
+   """
+   if header:
+      snapshot.readline()
+   for line in snapshot:
+      path, size, errors = json.loads(line.decode("ascii"))
+      yield path, size, errors
+
+def snapshot_key( path ):
+   """
+   Sort key of a snapshot entry: paths are compared by component and a
+   folder comes after all its descendants (post-order). This is the order in
+   which the walk completes the folders.
+   """
+   return [(0, part) for part in path.split("/") if part] + [(1,)]
+
+def check_snapshots( old, new ):
+   """
+   Make sure that two snapshots, given by their headers (see
+   "read_snapshot_header"), can be compared. Raises ValueError if one has
+   allocated and the other apparent sizes. Returns a warning if they are
+   snapshots of different folders, None otherwise.
+   """
+   if bool(old.get("allocated")) != bool(new.get("allocated")):
+      raise ValueError( "Only one of the snapshots has allocated sizes "
+            "(--allocated), their sizes can not be compared" )
+   if old.get("root") != new.get("root"):
+      return "The snapshots are of different folders (%s and %s)" % (
+            old.get("root"), new.get("root"))
+   return None
+
+def diff_snapshots( old, new, top=10, depth=None ):
+   """
+   Compare two snapshots (iterables as returned by "read_snapshot") and
+   return the <top> folders with the largest size change as a list of
+   (path, old_size, new_size) tuples, largest change first. Folders missing
+   in one snapshot count as size 0 there. With <depth>, only folders up to
+   that many levels below the root are considered.
+
+   Both inputs are consumed as a sorted merge, so memory use only depends on
+   <top>, not on the size of the snapshots.
+   """
+   def advance( rows ):
+      row = next(rows, None)
+      if row is None:
+         return None, None
+      return row, snapshot_key(row[0])
+
+   heap = []
+   counter = 0
+   old = iter(old)
+   new = iter(new)
+   old_row, old_key = advance( old )
+   new_row, new_key = advance( new )
+   while old_row is not None or new_row is not None:
+      if new_row is None or (old_row is not None and old_key < new_key):
+         path, old_size, new_size = old_row[0], old_row[1], 0
+         old_row, old_key = advance( old )
+      elif old_row is None or new_key < old_key:
+         path, old_size, new_size = new_row[0], 0, new_row[1]
+         new_row, new_key = advance( new )
+      else:
+         path, old_size, new_size = new_row[0], old_row[1], new_row[1]
+         old_row, old_key = advance( old )
+         new_row, new_key = advance( new )
+
+      if depth is not None and path and path.count("/") >= depth:
+         continue
+      # the counter keeps the heap from comparing paths on equal deltas
+      counter += 1
+      item = (abs(new_size - old_size), counter, path, old_size, new_size)
+      if len(heap) < top:
+         heapq.heappush(heap, item)
+      else:
+         heapq.heappushpop(heap, item)
+   return [item[2:] for item in sorted(heap, reverse=True)]
+
+def print_diff( changes, term=None ):
+   """
+   Prints the output of "diff_snapshots", colored for <term>
+   """
+   if not changes:
+      return
+   term = term or PlainTerminal()
+   name_len = max(len(x[0] or ".") for x in changes)
+   for path, old_size, new_size in changes:
+      delta = new_size - old_size
+      print "%s%-*s%s %10s -> %10s %s%s%s%s" % (term.BLUE, name_len,
+            path or ".", term.NORMAL, human_readable(old_size),
+            human_readable(new_size), delta > 0 and term.RED or term.GREEN,
+            delta < 0 and "-" or "+", human_readable(abs(delta)),
+            term.NORMAL)
+
+def print_json( levels ):
+   """
+   Write a list of (level, results) tuples, as returned by "get_tree_sizes",
+   as JSON to stdout. Each entry becomes an object with the keys "path",
+   "depth", "size" and "errors".
+   """
+   json.dump([{"path": root, "depth": level, "size": size, "errors": errors}
+         for level, results in levels for root, size, errors in results],
+         sys.stdout, indent=1)
+   sys.stdout.write("\n")
+
+def pretty_print( results, relative_to=None, term=None ):
    """
    Prints the folder sizes as a pretty console graph
+
+   <results> is a list of (path, size, errors) tuples or of SizeTree nodes,
+   e.g. "SizeTree(path).children". Entries are labelled with their base
+   name, or with their path relative to <relative_to> if given. Colors and
+   the width are taken from <term>, plain 80 columns by default.
+   """
+   for line in format_results( results, relative_to, term=term ):
+      print line
+
+def format_results( results, relative_to=None, warn=True, term=None ):
+   """
+   Returns the lines printed by "pretty_print"
    """
    if not results:
-      return
+      return []
+   term = term or PlainTerminal()
+   results = [isinstance(x, SizeTree) and (x.path, x.size, x.errors) or x
+         for x in results]
+
+   def display( path ):
+      if relative_to:
+         return relpath( path, relative_to )
+      return basename( path )
 
    # determine console width
-   console_width = TERM.COLS or 80
+   console_width = term.COLS or 80
 
    # minimum progress bar length
    bar_len_min = 5
@@ -288,12 +1422,13 @@ def pretty_print( results ):
    error_len = 9
 
    # determine the maximum length of folder names
-   name_len = max([ len(x[0]) for x in results ])
+   name_len = max([ len(display(x[0])) for x in results ])
    name_len_max = console_width - bar_len_min - size_len - error_len - whitespace_len
 
    do_truncate = False
    if name_len > name_len_max:
-      sys.stderr.write( "WARNING: filename length exceeded maximum width. Truncating!\n" )
+      if warn:
+         sys.stderr.write( "WARNING: filename length exceeded maximum width. Truncating!\n" )
       do_truncate = True
       name_len = name_len_max
 
@@ -307,22 +1442,114 @@ def pretty_print( results ):
    line_template = "%%s%%-%ds%%s %%%ds [%%-%ds] %%s(err: %%4d)%%s" % (name_len, size_len, bar_len)
 
    # for the progress bar
-   max_size = sorted_results[-1][1]
+   max_size = sorted_results[-1][1] or 1
 
+   lines = []
    for root, size, errors in sorted_results:
       pb_char_count = int(float(size) / max_size * bar_len)
       progress_bar = pb_char_count * "#"
-      displayname = basename(root)
-      print line_template % (
-            isdir(root) and TERM.BLUE or TERM.NORMAL,
+      displayname = display(root)
+      lines.append(line_template % (
+            isdir(root) and term.BLUE or term.NORMAL,
             do_truncate and displayname[0:name_len_max] or displayname,
-            TERM.NORMAL,
+            term.NORMAL,
             human_readable(size),
             progress_bar,
-            errors and TERM.RED or TERM.NORMAL,
+            errors and term.RED or term.NORMAL,
             errors,
-            TERM.NORMAL
-            )
+            term.NORMAL
+            ))
+   return lines
+
+class Progress(object):
+   """
+   Live progress display for long scans.
+
+   The walkers report each scanned folder with "update" and each completely
+   sized entry with "entry_done". A status line (files/s, bytes/s and the
+   current folder) and the table of finished entries, largest last, are
+   redrawn in place using the "UP", "BOL" and "CLEAR_EOL" codes of <term>.
+   Redrawing happens at most every <interval> seconds, so it never slows
+   down the scan.
+   """
+
+   def __init__(self, term, stream=sys.stdout, interval=0.25):
+      self.term = term
+      self.stream = stream
+      self.interval = interval
+      self.files = 0
+      self.bytes = 0
+      self.current = ""
+      self.finished = []
+      self._lock = threading.Lock()
+      self._start = time.time()
+      # nothing is drawn for scans shorter than <interval>
+      self._last = self._start
+      self._lines = 0
+
+   def update(self, path, files, size):
+      self._lock.acquire()
+      try:
+         self.files += files
+         self.bytes += size
+         self.current = path
+         now = time.time()
+         if now - self._last >= self.interval:
+            self._last = now
+            self._render( now )
+      finally:
+         self._lock.release()
+
+   def entry_done(self, path, size, errors):
+      self._lock.acquire()
+      try:
+         self.finished.append((path, size, errors))
+      finally:
+         self._lock.release()
+
+   def close(self):
+      """
+      Remove the progress display from the terminal
+      """
+      self._lock.acquire()
+      try:
+         self.stream.write(self.term.UP * self._lines + self.term.BOL +
+               self.term.CLEAR_EOS)
+         self.stream.flush()
+         self._lines = 0
+      finally:
+         self._lock.release()
+
+   def _render(self, now):
+      term = self.term
+      elapsed = max(now - self._start, 0.001)
+      # keep the drawing on screen, cursor movements cannot scroll back
+      rows = (term.LINES or 24) - 2
+      largest = sorted(self.finished, key=lambda x: x[1])[-rows:]
+      lines = format_results( largest, warn=False, term=term )
+      status = "%d files (%d/s), %s (%s/s) %s" % (self.files,
+            self.files / elapsed, human_readable(self.bytes),
+            human_readable(self.bytes / elapsed), self.current)
+      lines.append(status[:(term.COLS or 80) - 1])
+
+      output = [term.UP * self._lines]
+      for line in lines:
+         output.append(term.BOL + term.CLEAR_EOL + line + "\n")
+      output.append(term.CLEAR_EOS)
+      self.stream.write("".join(output))
+      self.stream.flush()
+      self._lines = len(lines)
+
+def open_progress( options, term ):
+   """
+   Return a Progress display on <term> if the command-line <options> and
+   the terminal allow it, None otherwise.
+   """
+   if options.quiet or options.verbose or options.no_progress:
+      return None
+   if not term.UP or not sys.stdout.isatty():
+      return None
+   return Progress( term )
 
 def get_mounts():
    """
@@ -336,10 +1563,24 @@ def get_mounts():
    if not exists( "/proc/mounts" ):
       raise UserWarning("'/proc/mounts' not found!")
 
-   mounts = open("/proc/mounts").readlines()
+   return parse_mounts( open("/proc/mounts") )
+
+def _unescape_mount( value ):
+   """
+   /proc/mounts escapes blanks and backslashes as octal sequences ("\\040")
+   """
+   return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), value)
+
+def parse_mounts( lines ):
+   """
+   Parse lines in the format of "/proc/mounts" into a dictionary keyed by
+   mount point. If a folder is mounted more than once, the last (topmost)
+   mount wins.
+   """
    output = {}
-   for line in mounts:
+   for line in lines:
       device, mountpoint, type, options, fsdump, fspass = line.strip().split()
+      mountpoint = _unescape_mount( mountpoint )
       if type == "rootfs":
          # This seems "ignorable"
          continue
@@ -356,7 +1597,9 @@ def get_mounts():
    return output
 
 def get_options():
-   usage  = "usage: %prog [options] <folder>\nhelp: %prog --help"
+   usage  = "usage: %prog [options] <folder>\n" \
+            "       %prog [options] diff <old-snapshot> <new-snapshot>\n" \
+            "help: %prog --help"
    parser = OptionParser(usage=usage)
    parser.add_option( "-f", "--follow-symlinks", dest="follow_symlinks",
          help="Include symlinks in the report. By default, this is disabled.",
@@ -385,6 +1628,74 @@ def get_options():
          help="Print verbose output. Default is OFF",
          default=False,
          action="store_true")
+   parser.add_option( "-j", "--jobs", dest="jobs", help="Number of threads " \
+         "used to scan the folders. Work is split per sub-folder, so even "   \
+         "one big folder is scanned concurrently. Default is 1",
+         default=1,
+         type="int",
+         metavar="N")
+   parser.add_option( "-l", "--count-links", dest="count_links", help="Count " \
+         "the size of hard-linked files once for every link. By default, "    \
+         "each file is only counted the first time it is seen.",
+         default=False,
+         action="store_true")
+   parser.add_option( "-a", "--allocated", dest="allocated", help="Report " \
+         "the space allocated on disk instead of the apparent file size. "    \
+         "This differs a lot for sparse files like VM images. By default "    \
+         "the apparent size is reported.",
+         default=False,
+         action="store_true")
+   parser.add_option( "-d", "--depth", dest="depth", help="Report folders " \
+         "down to N levels below <folder> instead of only its direct "        \
+         "entries. All levels are computed in a single walk. See --top. "     \
+         "With 'diff', only folders down to N levels are compared.",
+         default=0,
+         type="int",
+         metavar="N")
+   parser.add_option( "-t", "--top", dest="top", help="With --depth, only " \
+         "report the K largest folders of each level. With 'diff', report "   \
+         "the K largest changes. Default is 10",
+         default=10,
+         type="int",
+         metavar="K")
+   parser.add_option( "--no-progress", dest="no_progress", help="Do not " \
+         "show the live progress display. It is only shown on terminals "     \
+         "and disabled by --quiet and --verbose.",
+         default=False,
+         action="store_true")
+   parser.add_option( "-e", "--export", dest="export", help="Write the " \
+         "size of every folder below <folder> to the snapshot FILE (one "     \
+         "JSON document per line, gzip compressed if FILE ends in .gz). Use " \
+         "'diff' to compare two snapshots.",
+         default=None,
+         metavar="FILE")
+   parser.add_option( "--json", dest="json", help="Print the report as " \
+         "JSON instead of a graph. Implies --quiet.",
+         default=False,
+         action="store_true")
+   parser.add_option( "-b", "--backend", dest="backend", help="How folders " \
+         "are read. 'scandir' (the default) reads the file types with the "   \
+         "listing and stats one file at a time. 'batch' stats the files of "  \
+         "large folders in parallel, which helps on high-latency storage.",
+         default="scandir",
+         type="choice",
+         choices=sorted(BACKENDS))
+   parser.add_option( "--cache", dest="cache", help="Use the size cache in " \
+         "~/.cache/pydu, trading accuracy for speed. The cache remembers the " \
+         "size of each folder and skips folders whose modification time did " \
+         "not change since the last run. Files which grow or shrink in place " \
+         "(logs, VM images, databases) do not change the modification time "  \
+         "of their folder, so their old size is reported until the cache is " \
+         "rebuilt. Not used with --export. By default, this is disabled.",
+         default=False,
+         action="store_true")
+   parser.add_option( "--no-cache", dest="cache", help=SUPPRESS_HELP,
+         action="store_false")
+   parser.add_option( "--rebuild-cache", dest="rebuild_cache", help="Drop " \
+         "the size cache and rescan everything, then use the cache like "     \
+         "--cache.",
+         default=False,
+         action="store_true")
    parser.description = ("Determines the size on disk for each entry in the "
       "specified folder. It ignores symlinks and virtual file systems. "
       "Optionally, you can restrict the report on one filesystem/device.")
@@ -394,25 +1705,101 @@ def get_options():
       sys.exit(9)
    return (options, args)
 
+class MountIndex(object):
+   """
+   Longest-prefix lookup of mount points.
+
+   The mount points are stored in a trie of path components, so a lookup
+   costs one dictionary access per component of the path instead of a
+   string comparison per mounted volume. Build it once and reuse it.
+   """
+
+   def __init__(self, mounts):
+      """
+      @param mounts: A dictionary containing mount information (retrieve it
+                     with get_mounts)
+      """
+      # Each node is a dict mapping a path component to the next node. The
+      # mount information of a node is stored under the key None.
+      self._root = {}
+      for mountpoint, info in mounts.items():
+         node = self._root
+         for part in mountpoint.split("/"):
+            if part:
+               node = node.setdefault(part, {})
+         node[None] = info
+
+   def lookup(self, path):
+      """
+      Returns the mount information of the volume containing <path>
+      """
+      node = self._root
+      found = node.get(None)
+      for part in abspath(path).split("/"):
+         if not part:
+            continue
+         node = node.get(part)
+         if node is None:
+            break
+         found = node.get(None, found)
+      return found
+
 def get_mountpoint( path, mounts ):
    """
    Returns the mountpoint of the specified folder
 
    @param path: The path
-   @param mounts: A dictionary containing mount information (retrieve it with
-                  get_mounts)
+   @param mounts: A MountIndex or a dictionary containing mount information
+                  (retrieve it with get_mounts). Build a MountIndex when
+                  looking up many paths.
    """
-   path = abspath(path)
-   for mountpoint in mounts.keys():
-      if path.startswith( mountpoint ):
-         return mounts[mountpoint]
+   if not isinstance(mounts, MountIndex):
+      mounts = MountIndex(mounts)
+   return mounts.lookup(path)
 
 if __name__ == "__main__":
 
    TERM = TerminalController()
    options, args = get_options()
+   if options.json:
+      options.quiet = True
+
+   if len(args) == 3 and args[0] == "diff":
+      old, new = open_snapshot( args[1] ), open_snapshot( args[2] )
+      try:
+         warning = check_snapshots( read_snapshot_header( old ),
+               read_snapshot_header( new ) )
+      except ValueError, e:
+         sys.stderr.write( "%s\n" % e )
+         sys.exit(1)
+      if warning:
+         sys.stderr.write( "WARNING: %s\n" % warning )
+      changes = diff_snapshots( read_snapshot( old, header=False ),
+            read_snapshot( new, header=False ), options.top,
+            options.depth or None )
+      if options.json:
+         json.dump([{"path": path, "old": old_size, "new": new_size}
+               for path, old_size, new_size in changes], sys.stdout,
+               indent=1)
+         sys.stdout.write("\n")
+      else:
+         print_diff( changes, TERM )
+      sys.exit(0)
+
+   if options.depth or options.export:
+      levels = get_tree_sizes( args[0], options, TERM )
+   else:
+      levels = [(1, get_first_level_sizes( args[0], options, TERM ))]
 
-   pretty_print( get_first_level_sizes( args[0], options ) )
+   if options.json:
+      print_json( levels )
+   elif options.depth:
+      for level, results in levels:
+         if results:
+            print "%sLevel %d%s" % (TERM.BOLD, level, TERM.NORMAL)
+            pretty_print( results, relative_to=abspath(args[0]), term=TERM )
+   else:
+      pretty_print( levels[0][1], term=TERM )
 
    if not options.verbose and not options.quiet:
       print TERM.YELLOW + "NOTE: Enabling the verbose flag will print " \
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Benchmark of the image size probing of wpclassifier
+
+Reads the dimensions of every image in a folder with each of the MODES:
+
+* probe: the header parsers of ``wpclassifier.imagesize``, without PIL
+* pil: ``PIL.Image.open(filename).size``, as wpclassifier used to do
+* read_size: ``wpclassifier.imagesize.read_size``, the header parsers with
+  the PIL fallback
+
+Each mode runs in a fresh subprocess, so loading PIL counts like it does for
+a run of wpclassifier, and reports files/s. The sizes found by each mode are
+compared with PIL, a difference is an error.
+
+Without --input, a synthetic set of wallpapers is generated (with PIL): the
+formats in FORMATS at common resolutions, JPEGs with a large EXIF segment
+before the frame header.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+from os.path import join, abspath, dirname
+
+sys.path.insert(0, dirname(abspath(__file__)))
+
+FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP', 'BMP')
+RESOLUTIONS = ((1920, 1080), (1920, 1200), (2560, 1440), (1680, 1050),
+               (1366, 768), (3840, 2160), (1080, 1920))
+# bytes of EXIF data written in front of the JPEG frame header
+EXIF_SIZE = 32 * 1024
+SEED = 42
+
+
+def make_image(fmt, width, height):
+    """
+    Returns the encoded bytes of a *width* x *height* image in *fmt*.
+    """
+    from io import BytesIO
+    from PIL import Image
+    img = Image.new('RGB', (width, height), (30, 90, 160))
+    output = BytesIO()
+    if fmt == 'JPEG':
+        # an EXIF segment with a large maker note, like cameras write
+        exif = b'Exif\0\0' + b'\0' * EXIF_SIZE
+        img.save(output, fmt, exif=exif)
+    elif fmt == 'GIF':
+        img.convert('P').save(output, fmt)
+    else:
+        img.save(output, fmt)
+    return output.getvalue()
+
+
+def make_images(folder, count):
+    """
+    Write *count* images to *folder*, copies of one template per format and
+    resolution.
+    """
+    rng = random.Random(SEED)
+    templates = {}
+    for i in range(count):
+        fmt = FORMATS[i % len(FORMATS)]
+        width, height = rng.choice(RESOLUTIONS)
+        key = fmt, width, height
+        if key not in templates:
+            templates[key] = make_image(fmt, width, height)
+        filename = join(folder, 'wp%06d.%s' % (i, fmt.lower()))
+        with open(filename, 'wb') as fptr:
+            fptr.write(templates[key])
+
+
+def probe_mode(filename):
+    from wpclassifier.imagesize import read_size
+    try:
+        return read_size(filename, fallback=False)[:2]
+    except IOError:
+        return None
+
+
+def pil_mode(filename):
+    from PIL import Image
+    try:
+        return Image.open(filename).size
+    except IOError:
+        return None
+
+
+def read_size_mode(filename):
+    from wpclassifier.imagesize import read_size
+    try:
+        return read_size(filename)[:2]
+    except IOError:
+        return None
+
+
+MODES = {
+    'probe': probe_mode,
+    'pil': pil_mode,
+    'read_size': read_size_mode,
+}
+
+
+def child(mode, folder):
+    """
+    Runs in the benchmark subprocess: read the size of every file in
+    *folder* in *mode* and print the elapsed time and sizes as JSON.
+    """
+    names = sorted(os.listdir(folder))
+    function = MODES[mode]
+    start = time.time()
+    sizes = [function(join(folder, name)) for name in names]
+    elapsed = time.time() - start
+    print(json.dumps({
+        'elapsed': elapsed,
+        'sizes': dict(zip(names, sizes)),
+    }))
+
+
+def run_mode(mode, folder):
+    output = subprocess.check_output([sys.executable, abspath(__file__),
+                                      '--run', mode, folder])
+    return json.loads(output.decode('utf8'))
+
+
+def bench(folder, modes, repeat):
+    """
+    Time every mode on the images in *folder*. Returns a dict: mode ->
+    result dict, and a list of ``(mode, name, size, pil_size)`` for the
+    files where the mode disagrees with PIL.
+    """
+    results = {}
+    for mode in modes:
+        runs = [run_mode(mode, folder) for _ in range(repeat)]
+        results[mode] = min(runs, key=lambda x: x['elapsed'])
+
+    reference = results.get('pil') or run_mode('pil', folder)
+    differences = []
+    for mode in modes:
+        for name, size in sorted(results[mode]['sizes'].items()):
+            expected = reference['sizes'][name]
+            if size is not None and size != expected:
+                differences.append((mode, name, size, expected))
+    return results, differences
+
+
+def print_results(count, results):
+    print('%d files' % count)
+    for mode in sorted(results):
+        result = results[mode]
+        unknown = sum(1 for size in result['sizes'].values() if size is None)
+        print('   %-10s %10.0f files/s %8.3fs %6d unrecognised' % (
+            mode, count / max(result['elapsed'], 1e-6), result['elapsed'],
+            unknown))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-i', '--input', metavar='DIR',
+                      help='Folder with the images to probe. Default: a '
+                      'generated set of --files images')
+    parser.add_option('-n', '--files', type='int', default=5000,
+                      help='Number of generated images. Default: %default')
+    parser.add_option('-m', '--modes', default=','.join(sorted(MODES)),
+                      help='Comma separated modes. Default: %default')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Runs per mode, the best is reported. '
+                      'Default: %default')
+    parser.add_option('--run', nargs=2, metavar='MODE DIR',
+                      help='Internal: run one mode in this process')
+    options, _ = parser.parse_args()
+
+    if options.run:
+        child(*options.run)
+        return 0
+
+    modes = [mode.strip() for mode in options.modes.split(',')]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('Unknown mode: %s' % mode)
+
+    folder = options.input
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix='wpclassifier-bench-')
+    try:
+        if options.input is None:
+            make_images(folder, options.files)
+        results, differences = bench(folder, modes, options.repeat)
+    finally:
+        if options.input is None:
+            shutil.rmtree(folder)
+
+    print_results(len(results[modes[0]]['sizes']), results)
+    for mode, name, size, expected in differences:
+        print('FAIL: %s: %s is %r, PIL says %r' % (mode, name, size,
+                                                     expected))
+    return differences and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
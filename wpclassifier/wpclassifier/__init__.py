@@ -1,6 +1,15 @@
-from PIL import Image
 from fractions import Fraction
+from multiprocessing import cpu_count
+from os.path import join, dirname, basename, isdir
+from Queue import Queue
+import errno
 import logging
+import os
+import threading
+
+from wpclassifier.imagesize import read_size
+from wpclassifier.place import METHODS
+from wpclassifier.scan import iter_images
 
 LOG = logging.getLogger(__name__)
 
@@ -8,14 +17,29 @@ F_SIMPLE = 's'
 F_ASPECT = 'a'
 F_APPROX_ASPECT = 'x'
 
+#: Files waiting for each stage of the pipeline (see ``move_files``)
+QUEUE_SIZE = 256
+
 
-def get_image_size(filepath):
+def get_image_size(filepath, cache=None):
     """
     Returns a 2-tuple of the image dimensions. For example: (1024, 768)
+
+    The dimensions are read from the file header (see
+    :py:mod:`wpclassifier.imagesize`), PIL is only used for formats which
+    are not handled there. If a :py:class:`wpclassifier.cache.ProbeCache`
+    is given as ``cache``, the file is only read if it is not in the cache.
     """
     try:
-        img = Image.open(filepath)
-        return img.size
+        if cache is None:
+            width, height, _ = read_size(filepath)
+            return width, height
+        stat_result = os.stat(filepath)
+        size = cache.get(stat_result)
+        if size is None:
+            size = read_size(filepath)
+            cache.put(stat_result, *size)
+        return size[0], size[1]
     except Exception, exc:
         LOG.error("Unable to open file %s (%s)" % (filepath, str(exc)))
         return None
@@ -55,7 +79,7 @@ def aspect_folder(width, height, format_=F_SIMPLE):
     return "%d@%d" % (width, height)
 
 
-def get_image_aspect(filepath, approximate=False):
+def get_image_aspect(filepath, approximate=False, cache=None):
     """
     Returns the image aspect ratio as a tuple of width/height. This simplifies
     the ratios as much as possible. Which may result in unexpected values.
@@ -65,17 +89,96 @@ def get_image_aspect(filepath, approximate=False):
     :param filepath: The filename
     :param approximate: Whether to approximate the size or not. See
                         :py:func:`simplify`
+    :param cache: A :py:class:`wpclassifier.cache.ProbeCache` or ``None``
     """
-    size = get_image_size(filepath)
+    size = get_image_size(filepath, cache)
     if not size:
         return None
     return simplify(size[0], size[1], approximate=approximate)
 
 
-def move_files(input_dir, output_dir, format_=F_SIMPLE, move=False):
+def target_folder(in_file, format_=F_SIMPLE, cache=None):
+    """
+    Returns the name of the classification folder for the image
+    ``in_file``, or ``None`` if its size cannot be determined.
+    """
+    if format_ in (F_ASPECT, F_APPROX_ASPECT):
+        approximate = format_ == F_APPROX_ASPECT
+        aspect = get_image_aspect(in_file, approximate, cache)
+        if aspect:
+            return aspect_folder(aspect[0], aspect[1], format_=format_)
+    else:
+        size = get_image_size(in_file, cache)
+        if size:
+            return "%dx%d" % size
+    return None
+
+
+def makedirs(path):
+    """
+    Create the folder ``path`` and its parents unless it already exists.
+    Other threads (or processes) may create it at the same time.
+    """
+    try:
+        os.makedirs(path)
+    except OSError, exc:
+        if exc.errno != errno.EEXIST or not isdir(path):
+            raise
+
+
+def place_file(in_file, out_file, move=False, method=None):
+    """
+    Copy (or with ``move``, move) ``in_file`` to ``out_file``, whose folder
+    must exist. Errors are logged.
+
+    ``method`` is the name of one of the :py:data:`wpclassifier.place.METHODS`
+    and overrides ``move``.
+    """
+    if method is None:
+        method = move and 'move' or 'copy'
+    try:
+        op_text = METHODS[method](in_file, out_file)
+        LOG.info("%s %s to %s" % (op_text, basename(in_file),
+            dirname(out_file)))
+    except Exception, exc:
+        LOG.error(str(exc))
+
+
+class _Folders(object):
+    """
+    The target folders, each is created the first time a file goes there.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.created = set()
+        self.lock = threading.Lock()
+
+    def out_file(self, clazz, name):
+        """
+        Returns the target of the file ``name`` (relative to the input
+        folder) in the folder ``clazz``, after creating its folder.
+        """
+        folder = join(clazz, dirname(name))
+        if folder not in self.created:
+            # makedirs copes with races, the lock only avoids the syscalls
+            makedirs(join(self.output_dir, folder))
+            with self.lock:
+                self.created.add(folder)
+        return join(self.output_dir, clazz, name)
+
+
+def move_files(input_dir, output_dir, format_=F_SIMPLE, move=False, jobs=1,
+        probe_jobs=None, recursive=False, cache=None, method=None):
     """
     Move files to the classification folders. The source folder is read *non*
-    recursively!
+    recursively, unless ``recursive`` is set. Files in sub-folders keep their
+    path relative to ``input_dir`` inside the classification folder, so
+    images with the same name do not overwrite each other.
+
+    Only images are classified (see :py:func:`wpclassifier.scan.iter_images`),
+    other files are skipped without being opened with PIL. The files are
+    classified while the input folder is being read.
 
     The names of the target folders depend on the ``format_`` value:
 
@@ -97,41 +200,111 @@ def move_files(input_dir, output_dir, format_=F_SIMPLE, move=False):
       - A resolution of ``1554x1013`` goes to ``14@9``. See
         :py:func:`simplify`
 
+    With ``jobs`` > 1, the files are handled by a pipeline (see
+    :py:func:`_pipeline`): ``probe_jobs`` threads (default: one per CPU)
+    determine the target folders while ``jobs`` threads copy or move the
+    files.
+
     :param input_dir: The directory containing the pictures.
     :param output_dir: The destination folder.
     :param format_: The directory naming scheme. Use one of
                     :py:const:`F_SIMPLE`, :py:const:`F_ASPECT` or
                     :py:const:`F_APPROX_ASPECT`
+    :param move: Move the files instead of copying them.
+    :param jobs: Number of files copied or moved at the same time. Values
+                 below 1 count as 1.
+    :param probe_jobs: Number of files probed at the same time (at least
+                       1).
+    :param recursive: Also classify the images in the sub-folders (except
+                      ``output_dir``).
+    :param cache: A :py:class:`wpclassifier.cache.ProbeCache` with the sizes
+                  of images seen before, or ``None``.
+    :param method: How the files are placed, one of the names in
+                   :py:data:`wpclassifier.place.METHODS` (overrides
+                   ``move``).
     """
-    from os import listdir, makedirs
-    from os.path import join, exists, dirname, basename
-    from shutil import move as mv, copy2 as cp
-    for filename in listdir(input_dir):
-        in_file = join(input_dir, filename)
-        clazz = None
-        if format_ in (F_ASPECT, F_APPROX_ASPECT):
-            approximate = format_ == F_APPROX_ASPECT
-            aspect = get_image_aspect(in_file, approximate)
-            if aspect:
-                clazz = aspect_folder(aspect[0], aspect[1], format_=format_)
-        else:
-            size = get_image_size(in_file)
-            if size:
-                clazz = "%dx%d" % size
+    if method is None:
+        method = move and 'move' or 'copy'
+    in_files = iter_images(input_dir, recursive, exclude=[output_dir])
+    folders = _Folders(output_dir)
+    if jobs > 1:
+        if probe_jobs is None:
+            probe_jobs = cpu_count()
+        # with no thread on one side, the pipeline would never finish
+        probe_jobs = max(1, probe_jobs)
+        _pipeline(in_files, folders, format_, method, jobs, probe_jobs,
+                cache)
+        return
 
+    for in_file, name in in_files:
+        clazz = target_folder(in_file, format_, cache)
         if not clazz:
             LOG.error("Unable to determine output folder for %s" % in_file)
             continue
-        target_folder = join(output_dir, clazz)
-        if not exists(target_folder):
-            makedirs(target_folder)
-        out_file = join(target_folder, filename)
-
-        operation = move and mv or cp
-        op_text = move and "Moved" or "Copied"
-        try:
-            operation(in_file, out_file)
-            LOG.info("%s %s to %s" % (op_text, basename(in_file),
-                dirname(out_file)))
-        except Exception, exc:
-            LOG.error(str(exc))
+        out_file = folders.out_file(clazz, name)
+        place_file(in_file, out_file, method=method)
+
+
+def _pipeline(in_files, folders, format_, method, jobs, probe_jobs, cache):
+    """
+    Classify the ``(path, name)`` tuples from the iterable ``in_files`` (see
+    :py:func:`wpclassifier.scan.iter_images`) in two stages of threads,
+    connected by bounded queues:
+
+    * ``probe_jobs`` threads read the image sizes and create the target
+      folders,
+    * ``jobs`` threads copy or move the files.
+
+    Reading the headers and copying the data overlap, and the queues keep
+    the input from being read far ahead of the copies. All messages about
+    a file come from the thread handling it in the current stage, so they
+    are logged in order.
+    """
+    to_probe = Queue(QUEUE_SIZE)
+    to_place = Queue(QUEUE_SIZE)
+
+    def probe_worker():
+        while True:
+            task = to_probe.get()
+            if task is None:
+                return
+            in_file, name = task
+            try:
+                clazz = target_folder(in_file, format_, cache)
+                if not clazz:
+                    LOG.error("Unable to determine output folder for %s" %
+                            in_file)
+                    continue
+                out_file = folders.out_file(clazz, name)
+            except Exception, exc:
+                LOG.error("Unable to classify %s (%s)" % (in_file, exc))
+                continue
+            to_place.put((in_file, out_file))
+
+    def place_worker():
+        while True:
+            task = to_place.get()
+            if task is None:
+                return
+            # errors are logged by place_file
+            place_file(task[0], task[1], method=method)
+
+    def start(target, count):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    probers = start(probe_worker, probe_jobs)
+    placers = start(place_worker, jobs)
+    for task in in_files:
+        to_probe.put(task)
+    for _ in probers:
+        to_probe.put(None)
+    for thread in probers:
+        thread.join()
+    for _ in placers:
+        to_place.put(None)
+    for thread in placers:
+        thread.join()
@@ -0,0 +1,198 @@
+"""
+Persistent cache of the image sizes, stored in an SQLite database.
+
+An image is identified by ``(st_dev, st_ino, st_size, st_mtime_ns)``: if a
+file is replaced or modified, at least one of them changes and the image is
+probed again. Renaming or moving a file on the same file system keeps its
+entry, so images classified with ``--move`` are still known on the next run.
+"""
+from os.path import join, exists, dirname
+import logging
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+LOG = logging.getLogger(__name__)
+
+#: Maximum number of images kept in the cache
+MAX_ENTRIES = 1000000
+#: Changes are committed after this many images were looked up or added
+COMMIT_INTERVAL = 1000
+#: Bump whenever the layout of the cache changes
+SCHEMA_VERSION = 1
+
+
+def default_filename():
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+            join(os.path.expanduser('~'), '.cache'))
+    return join(cache_home, 'wpclassifier', 'sizes.sqlite')
+
+
+def _mtime_ns(stat_result):
+    mtime_ns = getattr(stat_result, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat_result.st_mtime * 1000000000)
+    return mtime_ns
+
+
+class ProbeCache(object):
+    """
+    Image sizes by file identity. Safe to use from several threads.
+
+    Entries are written in transactions, so an interrupted run leaves the
+    last committed state behind. A file which is not a valid database is
+    replaced by an empty cache. If the database fails while in use, the
+    cache is disabled for the rest of the run.
+
+    The least recently used entries are dropped once the cache holds more
+    than ``max_entries`` images.
+    """
+
+    def __init__(self, filename=None, max_entries=MAX_ENTRIES,
+            rebuild=False):
+        if filename is None:
+            filename = default_filename()
+        if dirname(filename) and not exists(dirname(filename)):
+            os.makedirs(dirname(filename))
+        self.filename = filename
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pending = 0
+        # files modified after this point may change again within the
+        # resolution of their timestamp. They are not cached.
+        self._recent = int((time.time() - 2) * 1000000000)
+        try:
+            self._open(rebuild)
+        except sqlite3.OperationalError:
+            # locked by another run, for example. Not damaged.
+            raise
+        except sqlite3.DatabaseError, exc:
+            LOG.warning("Replacing the damaged cache %s (%s)" % (filename,
+                    exc))
+            os.unlink(filename)
+            self._open(rebuild)
+
+    def _open(self, rebuild):
+        self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self._conn.text_factory = str
+        try:
+            version = self._conn.execute(
+                    "PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS images")
+                self._conn.execute("PRAGMA user_version = %d" %
+                        SCHEMA_VERSION)
+            self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS images ("
+                    "dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, "
+                    "width INTEGER, height INTEGER, format TEXT, "
+                    "used INTEGER, PRIMARY KEY (dev, ino))")
+            if rebuild:
+                self._conn.execute("DELETE FROM images")
+            self._run = self._conn.execute(
+                    "SELECT COALESCE(MAX(used), 0) + 1 FROM images"
+                    ).fetchone()[0]
+            self._conn.commit()
+        except sqlite3.DatabaseError:
+            self._conn.close()
+            raise
+
+    def _failed(self, exc):
+        LOG.error("Image size cache disabled (%s)" % exc)
+        try:
+            self._conn.close()
+        except sqlite3.Error:
+            pass
+        self._conn = None
+
+    def _written(self):
+        # commit now and then: a long run would otherwise keep the database
+        # locked, and lose everything if interrupted
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self._conn.commit()
+            self._pending = 0
+
+    def get(self, stat_result):
+        """
+        Returns a ``(width, height, format)`` tuple for the file described
+        by ``stat_result``, or ``None`` if it is unknown or has changed.
+        """
+        key = (stat_result.st_dev, stat_result.st_ino)
+        with self._lock:
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute(
+                        "SELECT size, mtime, width, height, format "
+                        "FROM images WHERE dev=? AND ino=?", key).fetchone()
+                if row is None or row[0] != stat_result.st_size or \
+                        row[1] != _mtime_ns(stat_result):
+                    return None
+                self._conn.execute(
+                        "UPDATE images SET used=? WHERE dev=? AND ino=?",
+                        (self._run,) + key)
+                self._written()
+            except sqlite3.DatabaseError, exc:
+                self._failed(exc)
+                return None
+        return row[2], row[3], row[4]
+
+    def put(self, stat_result, width, height, format_):
+        """
+        Store the size of the image described by ``stat_result``.
+        """
+        mtime = _mtime_ns(stat_result)
+        if mtime >= self._recent:
+            return
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO images "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+                        stat_result.st_dev, stat_result.st_ino,
+                        stat_result.st_size, mtime, width, height, format_,
+                        self._run))
+                self._written()
+            except sqlite3.DatabaseError, exc:
+                self._failed(exc)
+
+    def close(self):
+        """
+        Evict the least recently used images and write the cache to disk.
+        """
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                count = self._conn.execute(
+                        "SELECT COUNT(*) FROM images").fetchone()[0]
+                if count > self.max_entries:
+                    self._conn.execute("DELETE FROM images WHERE rowid IN ("
+                            "SELECT rowid FROM images ORDER BY used LIMIT ?)",
+                            (count - self.max_entries,))
+                self._conn.commit()
+                self._conn.close()
+            except sqlite3.DatabaseError, exc:
+                self._failed(exc)
+            self._conn = None
+
+
+def open_cache(filename=None, rebuild=False):
+    """
+    Returns a :py:class:`ProbeCache`, or ``None`` if it is not available.
+    """
+    if sqlite3 is None:
+        LOG.debug("sqlite3 is not available. Cache disabled.")
+        return None
+    try:
+        return ProbeCache(filename, rebuild=rebuild)
+    except (OSError, sqlite3.Error), exc:
+        LOG.error("Unable to open the image size cache (%s)" % exc)
+        return None
@@ -8,6 +8,8 @@ from wpclassifier import (
         F_APPROX_ASPECT,
         F_SIMPLE,
         F_ASPECT)
+from wpclassifier.cache import open_cache
+from wpclassifier.place import METHODS
 
 LOG = logging.getLogger(__name__)
 
@@ -26,12 +28,34 @@ def main():
             default=False, help="Be more verbose")
     parser.add_option('-m', '--move', dest='move', action='store_true',
             default=False, help="Instead of copying the files, the files "
-            "will be moved to the destination. Default=False")
+            "will be moved to the destination. Same as --method=move. "
+            "Default=False")
+    parser.add_option('--method', dest='method', type='choice',
+            choices=sorted(METHODS), default=None, help="How the files are "
+            "placed in the destination: auto, copy, move, hardlink, reflink "
+            "or kernel. See METHODS below. Default=auto")
     parser.add_option('-f', '--format', dest='format', default=F_SIMPLE,
             help='Target folder format. Can be one of {0}, {1} or {2}'.format(
                    F_SIMPLE,
                    F_ASPECT,
                    F_APPROX_ASPECT))
+    parser.add_option('-r', '--recursive', dest='recursive',
+            action='store_true', default=False, help="Also classify the "
+            "images in the sub-folders of the input folder. They keep their "
+            "relative path in the target folders. Default=False")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+            help="Number of files copied (or moved) at the same time. With "
+            "more than one, reading the image sizes and copying overlap. "
+            "Default=1")
+    parser.add_option('--probe-jobs', dest='probe_jobs', type='int',
+            default=None, help="Number of image sizes read at the same time "
+            "with --jobs. Default=one per CPU")
+    parser.add_option('--no-cache', dest='no_cache', action='store_true',
+            default=False, help="Do not use the cache of image sizes from "
+            "earlier runs (in ~/.cache/wpclassifier). Default=False")
+    parser.add_option('--rebuild-cache', dest='rebuild_cache',
+            action='store_true', default=False, help="Empty the cache of "
+            "image sizes before this run. Default=False")
     parser.add_option('-s', '--target-for', dest='target_for',
             metavar='SIZE', default=None,
             help='Show the target folder for a given resolution '
@@ -61,6 +85,33 @@ There are three different naming options for target folders:
     denominator will never be larger than 10. This results in an approximate
     destination for files. So the folder "16@9" might contain images which do
     not quite have this aspect ratio. But it will always be close.
+
+METHODS
+=======
+
+--method=auto (the default)
+    Files on the same filesystem as the destination are cloned (reflink)
+    if the filesystem supports it (Btrfs, XFS, ...): the copy shares the
+    data with the original until one of them is modified, and takes no
+    time. Other files are copied by the kernel (copy_file_range or
+    sendfile), or by Python if that is not possible.
+
+--method=copy
+    Copy the files with Python (shutil.copy2).
+
+--method=move
+    Move the files (the same as --move).
+
+--method=hardlink
+    Create a second name for each file. This takes no time nor space, but
+    the classified files are not copies: modifying one modifies the
+    original. Only possible on the same filesystem.
+
+--method=reflink
+    Always clone the files, fail if the filesystem can not do it.
+
+--method=kernel
+    Always copy with copy_file_range or sendfile.
 """
     parser.epilog = epilog
 
@@ -73,6 +124,15 @@ There are three different naming options for target folders:
                 options.target_for, target)
         sys.exit(0)
 
+    if options.move and options.method not in (None, 'move'):
+        parser.error('--move can not be used with --method=%s' %
+                options.method)
+    method = options.move and 'move' or options.method or 'auto'
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if options.probe_jobs is not None and options.probe_jobs < 1:
+        parser.error('--probe-jobs must be at least 1')
+
     if len(args) != 2:
         parser.print_help()
         sys.exit(9)
@@ -85,4 +145,13 @@ There are three different naming options for target folders:
 
     input_dir, output_dir = args
 
-    move_files(input_dir, output_dir, options.format, move=options.move)
+    cache = None
+    if not options.no_cache:
+        cache = open_cache(rebuild=options.rebuild_cache)
+    try:
+        move_files(input_dir, output_dir, options.format, jobs=options.jobs,
+                probe_jobs=options.probe_jobs, recursive=options.recursive,
+                cache=cache, method=method)
+    finally:
+        if cache is not None:
+            cache.close()
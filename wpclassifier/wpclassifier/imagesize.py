@@ -0,0 +1,190 @@
+"""
+Image dimensions read directly from the file headers.
+
+Only the first bytes of a file are read, the image data is never decoded.
+The formats wallpapers usually come in are parsed here:
+
+* JPEG: the segments are skipped up to the first SOF (start of frame)
+  marker, which holds the size. EXIF and ICC data before it are seeked over,
+  not read.
+* PNG: the IHDR chunk.
+* GIF: the logical screen descriptor.
+* WebP: the lossy (``VP8``), lossless (``VP8L``) and extended (``VP8X``)
+  formats.
+* BMP: the Windows and OS/2 bitmap headers.
+
+Other files, or files these parsers do not understand, are opened with PIL
+(see :py:func:`read_size`). PIL is only imported when this happens.
+"""
+from struct import unpack
+
+#: Bytes read from the start of every file. Enough for all headers except
+#: JPEG, where the size may come after large metadata segments.
+HEADER_SIZE = 32
+
+JPEG = 'JPEG'
+PNG = 'PNG'
+GIF = 'GIF'
+WEBP = 'WEBP'
+BMP = 'BMP'
+
+#: Bytes needed by :py:func:`is_image_header`
+SIGNATURE_SIZE = 12
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# the start of the formats above, and of TIFF, which PIL reads
+_SIGNATURES = (b'\xff\xd8\xff', _PNG_SIGNATURE, b'GIF87a', b'GIF89a', b'BM',
+               b'II*\0', b'MM\0*')
+
+# SOF markers, C4 (DHT), C8 (JPG) and CC (DAC) use the same range
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - frozenset((0xC4, 0xC8, 0xCC))
+# markers without a length field
+_JPEG_STANDALONE = frozenset([0x01] + list(range(0xD0, 0xD8)))
+_JPEG_SOS = 0xDA
+_JPEG_EOI = 0xD9
+
+
+def _png(header):
+    if (header[:8] != _PNG_SIGNATURE or header[12:16] != b'IHDR' or
+            len(header) < 24):
+        return None
+    width, height = unpack('>II', header[16:24])
+    return width, height, PNG
+
+
+def _gif(header):
+    if header[:6] not in (b'GIF87a', b'GIF89a') or len(header) < 10:
+        return None
+    width, height = unpack('<HH', header[6:10])
+    return width, height, GIF
+
+
+def _bmp(header):
+    if header[:2] != b'BM' or len(header) < 26:
+        return None
+    dib_size, = unpack('<I', header[14:18])
+    if dib_size == 12:
+        # OS/2 BITMAPCOREHEADER
+        width, height = unpack('<HH', header[18:22])
+    elif dib_size >= 40:
+        width, height = unpack('<ii', header[18:26])
+        # negative for images stored top-down
+        height = abs(height)
+    else:
+        return None
+    return width, height, BMP
+
+
+def _webp(header):
+    if header[:4] != b'RIFF' or header[8:12] != b'WEBP' or len(header) < 30:
+        return None
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and header[23:26] == b'\x9d\x01\x2a':
+        width, height = unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff, WEBP
+    if chunk == b'VP8L' and header[20:21] == b'\x2f':
+        bits, = unpack('<I', header[21:25])
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1, WEBP
+    if chunk == b'VP8X':
+        width = unpack('<I', header[24:27] + b'\0')[0] + 1
+        height = unpack('<I', header[27:30] + b'\0')[0] + 1
+        return width, height, WEBP
+    return None
+
+
+def _jpeg(fp, header):
+    """
+    Walk the JPEG segments of the file *fp* up to the first frame header.
+    """
+    if header[:3] != b'\xff\xd8\xff':
+        return None
+    fp.seek(2)
+    while True:
+        byte = fp.read(1)
+        if byte != b'\xff':
+            return None
+        marker = fp.read(1)
+        while marker == b'\xff':
+            # fill bytes
+            marker = fp.read(1)
+        if not marker:
+            return None
+        marker = ord(marker)
+        if marker in _JPEG_STANDALONE:
+            continue
+        if marker == _JPEG_SOS or marker == _JPEG_EOI:
+            # the image data starts without a frame header
+            return None
+        data = fp.read(2)
+        if len(data) < 2:
+            return None
+        length, = unpack('>H', data)
+        if length < 2:
+            return None
+        if marker in _JPEG_SOF:
+            data = fp.read(5)
+            if len(data) < 5:
+                return None
+            height, width = unpack('>xHH', data)
+            return width, height, JPEG
+        fp.seek(length - 2, 1)
+
+
+_PARSERS = (_png, _gif, _webp, _bmp)
+
+
+def is_image_header(header):
+    """
+    Returns whether the first :py:const:`SIGNATURE_SIZE` bytes of a file,
+    *header*, start like an image. A quick check to skip other files, the
+    image may still not be valid.
+    """
+    if header[:4] == b'RIFF':
+        return header[8:12] == b'WEBP'
+    return header.startswith(_SIGNATURES)
+
+
+def probe(fp):
+    """
+    Read the dimensions of the image in the binary file object *fp*, which
+    must be seekable and positioned at the start of the file.
+
+    Returns a ``(width, height, format)`` tuple, or ``None`` if the format is
+    not recognised or the header is not valid. *format* is one of
+    :py:const:`JPEG`, :py:const:`PNG`, :py:const:`GIF`, :py:const:`WEBP` or
+    :py:const:`BMP` (the names PIL uses).
+    """
+    header = fp.read(HEADER_SIZE)
+    for parser in _PARSERS:
+        size = parser(header)
+        if size is not None:
+            break
+    else:
+        size = _jpeg(fp, header)
+    if size is None or size[0] <= 0 or size[1] <= 0:
+        return None
+    return size
+
+
+def read_size(filepath, fallback=True):
+    """
+    Returns a ``(width, height, format)`` tuple for the image *filepath*. If
+    the header cannot be parsed by :py:func:`probe`, the file is opened with
+    PIL, unless *fallback* is false.
+
+    Raises ``IOError`` if the file cannot be read or is not an image, and
+    ``ImportError`` if PIL is needed but not installed.
+    """
+    with open(filepath, 'rb') as fp:
+        size = probe(fp)
+        if size is not None:
+            return size
+        if not fallback:
+            raise IOError('Unrecognised image header: %s' % filepath)
+        # imported here: loading PIL and its plugins costs more than
+        # probing thousands of headers
+        from PIL import Image
+        fp.seek(0)
+        img = Image.open(fp)
+        width, height = img.size
+        return width, height, img.format
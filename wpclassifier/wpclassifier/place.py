@@ -0,0 +1,206 @@
+"""
+Ways of placing a file into its classification folder.
+
+Each method is a function ``(in_file, out_file)`` returning the verb logged
+for the file ("Copied", "Moved", ...), see ``METHODS``:
+
+* ``copy``: ``shutil.copy2``, the data goes through Python.
+* ``move``: ``shutil.move``, a rename on the same file system.
+* ``hardlink``: a second name for the same file. Nothing is copied, but the
+  classified file *is* the input file: changing one changes the other.
+* ``reflink``: a copy sharing the data blocks with the input until either
+  is modified (``FICLONE`` on Btrfs, XFS and other copy-on-write file
+  systems). Only possible on the same file system.
+* ``kernel``: the data is copied by the kernel, with
+  ``os.copy_file_range`` (which also lets NFS and SMB servers copy on their
+  side) or ``os.sendfile``, without passing through Python. Falls back to
+  ``shutil.copyfile`` where neither is available (Python 2).
+* ``auto``: for files on the same file system as their target, a reflink
+  where it is supported, else a kernel copy (which may still fall back to
+  copying through Python). Hard links are never used automatically, since
+  the result would not be a copy.
+
+All copies keep the permission bits and times of the input file, like
+``copy2``. Like it, all methods refuse to place a file onto itself (when
+classifying an already classified folder, or after linking) with a
+``shutil.Error``. Clones and copies are written to a temporary file next to
+the target and renamed when complete, so an existing target is only ever
+replaced by a complete copy.
+"""
+from os.path import basename, dirname, exists, realpath, samefile
+import errno
+import os
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+#: Bytes per call of copy_file_range or sendfile
+KERNEL_CHUNK = 64 * 1024 * 1024
+
+# the errors meaning that a file system or kernel lacks a feature
+_UNSUPPORTED = frozenset([errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                          errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM,
+                          getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+# (input device, target device) pairs where reflinks failed
+_NO_REFLINK = set()
+
+
+def _check_same(in_file, out_file):
+    if exists(out_file) and samefile(in_file, out_file):
+        raise shutil.Error("`%s` and `%s` are the same file" % (in_file,
+                out_file))
+
+
+def _temporary(out_file):
+    """
+    Returns the ``(fd, name)`` of a new, empty file in the folder of
+    ``out_file``.
+    """
+    return tempfile.mkstemp(prefix='.%s.' % basename(out_file),
+            suffix='.tmp', dir=dirname(out_file))
+
+
+def _write_replacing(in_file, out_file, write):
+    """
+    Call ``write(source, target)`` with ``in_file`` open for reading and a
+    temporary file for writing, then give the temporary file the times and
+    permissions of ``in_file`` and rename it to ``out_file``. The temporary
+    file is removed if anything fails.
+    """
+    _check_same(in_file, out_file)
+    fd, temporary = _temporary(out_file)
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            with open(in_file, 'rb') as source:
+                write(source, target)
+        shutil.copystat(in_file, temporary)
+        os.rename(temporary, out_file)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def copy(in_file, out_file):
+    shutil.copy2(in_file, out_file)
+    return "Copied"
+
+
+def move(in_file, out_file):
+    shutil.move(in_file, out_file)
+    return "Moved"
+
+
+def hardlink(in_file, out_file):
+    _check_same(in_file, out_file)
+    # link the file, not a symbolic link to it (copies follow them too)
+    in_file = realpath(in_file)
+    try:
+        os.link(in_file, out_file)
+    except OSError, exc:
+        if exc.errno != errno.EEXIST:
+            raise
+        # replace the target, like a copy would: link to a free name first
+        fd, temporary = _temporary(out_file)
+        os.close(fd)
+        os.unlink(temporary)
+        os.link(in_file, temporary)
+        try:
+            os.rename(temporary, out_file)
+        except OSError:
+            os.unlink(temporary)
+            raise
+    return "Linked"
+
+
+def reflink(in_file, out_file):
+    """
+    Clone ``in_file`` to ``out_file``. Raises ``OSError`` (or ``IOError``)
+    if the file system does not support it.
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks need fcntl")
+
+    def clone(source, target):
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+    _write_replacing(in_file, out_file, clone)
+    return "Cloned"
+
+
+def _kernel_copy(source, target, size):
+    """
+    Copy ``size`` bytes between the open files ``source`` and ``target``
+    with copy_file_range or sendfile. Returns ``False`` if neither works on
+    these files and nothing has been copied.
+    """
+    in_fd, out_fd = source.fileno(), target.fileno()
+    for name in ('copy_file_range', 'sendfile'):
+        function = getattr(os, name, None)
+        if function is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if name == 'sendfile':
+                    count = function(out_fd, in_fd, copied,
+                            min(KERNEL_CHUNK, size - copied))
+                else:
+                    count = function(in_fd, out_fd,
+                            min(KERNEL_CHUNK, size - copied), copied, copied)
+                if not count:
+                    break  # the file was truncated meanwhile
+                copied += count
+        except OSError, exc:
+            if copied or exc.errno not in _UNSUPPORTED:
+                raise
+            continue
+        if not copied and size:
+            continue  # some file systems just return 0
+        if copied < size:
+            target.truncate(copied)
+        return True
+    return False
+
+
+def kernel_copy(in_file, out_file):
+
+    def write(source, target):
+        size = os.fstat(source.fileno()).st_size
+        if not _kernel_copy(source, target, size):
+            shutil.copyfileobj(source, target, 1024 * 1024)
+
+    _write_replacing(in_file, out_file, write)
+    return "Copied"
+
+
+def auto(in_file, out_file):
+    _check_same(in_file, out_file)
+    devices = (os.stat(in_file).st_dev, os.stat(dirname(out_file)).st_dev)
+    if devices[0] == devices[1] and devices not in _NO_REFLINK:
+        try:
+            return reflink(in_file, out_file)
+        except (IOError, OSError), exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+            # the file system can not do it, no need to try again
+            _NO_REFLINK.add(devices)
+    return kernel_copy(in_file, out_file)
+
+
+#: The placement methods by name
+METHODS = {
+    'copy': copy,
+    'move': move,
+    'hardlink': hardlink,
+    'reflink': reflink,
+    'kernel': kernel_copy,
+    'auto': auto,
+}
@@ -0,0 +1,116 @@
+"""
+Listing of the images in the input folder.
+
+Folders are read with ``scandir`` (``os.scandir`` or the ``scandir``
+package, else ``os.listdir``), one entry at a time: the first images are
+classified while the rest of a large tree is still being listed. Entries
+are filtered before any image is opened:
+
+* only regular files (or links to them) are kept, using the file type which
+  comes with the listing,
+* files with one of the ``EXTENSIONS`` are images,
+* the first bytes of other files are compared with the signatures of the
+  image formats (see :py:func:`wpclassifier.imagesize.is_image_header`).
+"""
+from os.path import join, splitext
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+import errno
+import logging
+import os
+
+from wpclassifier.imagesize import is_image_header, SIGNATURE_SIZE
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+LOG = logging.getLogger(__name__)
+
+#: File name extensions of images, in lower case
+EXTENSIONS = frozenset(['.jpg', '.jpeg', '.jpe', '.jfif', '.png', '.gif',
+                        '.webp', '.bmp', '.dib', '.tif', '.tiff'])
+
+
+class _ListdirEntry(object):
+    """
+    Minimal stand-in for ``os.DirEntry`` on interpreters without
+    ``scandir``.
+    """
+    __slots__ = ('name', 'path', '_lstat')
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = join(root, name)
+        self._lstat = None
+
+    def _mode(self, follow_symlinks):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and S_ISLNK(self._lstat.st_mode):
+            try:
+                return os.stat(self.path).st_mode
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                return 0  # a broken link, like os.DirEntry
+        return self._lstat.st_mode
+
+    def is_dir(self, follow_symlinks=True):
+        return S_ISDIR(self._mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks=True):
+        return S_ISREG(self._mode(follow_symlinks))
+
+
+def _iter_dir(path):
+    if scandir is not None:
+        return scandir(path)
+    return (_ListdirEntry(path, name) for name in os.listdir(path))
+
+
+def _looks_like_image(entry):
+    if splitext(entry.name)[1].lower() in EXTENSIONS:
+        return True
+    with open(entry.path, 'rb') as fp:
+        return is_image_header(fp.read(SIGNATURE_SIZE))
+
+
+def iter_images(input_dir, recursive=False, exclude=()):
+    """
+    Yields a ``(path, name)`` tuple for each image in ``input_dir``, where
+    ``name`` is the path relative to ``input_dir``. With ``recursive``, the
+    sub-folders are read too (but not symbolic links to folders), except
+    for the folders in ``exclude``.
+
+    Entries which cannot be read are logged and skipped.
+    """
+    exclude = frozenset(os.path.realpath(path) for path in exclude)
+    # Explicit stack instead of recursion: deep trees would otherwise hit the
+    # interpreter's recursion limit.
+    pending = [(input_dir, '')]
+    while pending:
+        folder, prefix = pending.pop()
+        try:
+            entries = _iter_dir(folder)
+            for entry in entries:
+                name = prefix + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and \
+                                os.path.realpath(entry.path) not in exclude:
+                            pending.append((entry.path, name + os.sep))
+                        continue
+                    if not entry.is_file():
+                        LOG.debug("Skipped %s (not a file)" % entry.path)
+                    elif _looks_like_image(entry):
+                        yield entry.path, name
+                    else:
+                        LOG.debug("Skipped %s (not an image)" % entry.path)
+                except (IOError, OSError), exc:
+                    LOG.error("Unable to read %s (%s)" % (entry.path, exc))
+        except OSError, exc:
+            LOG.error("Unable to list %s (%s)" % (folder, exc))